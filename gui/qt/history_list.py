@@ -113,7 +113,7 @@ class HistoryList(MyTreeWidget):
             super(HistoryList, self).on_doubleclick(item, column)
         else:
             tx_hash = item.data(0, Qt.UserRole)
-            tx = self.wallet.transactions.get(tx_hash)
+            tx = self.wallet.get_transaction(tx_hash)
             self.parent.show_transaction(tx)
 
     def update_labels(self):
@@ -152,7 +152,7 @@ class HistoryList(MyTreeWidget):
 
         tx_URL = block_explorer_URL(self.config, 'tx', tx_hash)
         height, conf, timestamp = self.wallet.get_tx_height(tx_hash)
-        tx = self.wallet.transactions.get(tx_hash)
+        tx = self.wallet.get_transaction(tx_hash)
         is_relevant, is_mine, v, fee = self.wallet.get_wallet_delta(tx)
         is_unconfirmed = height <= 0
         pr_key = self.wallet.invoices.paid.get(tx_hash)
@@ -254,7 +254,10 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
             return
 
         if self.storage.requires_upgrade():
-            self.storage.upgrade()
+            def on_progress(fraction):
+                self.please_wait.setText(_('Upgrading wallet format...') + ' %d%%' % (100 * fraction))
+                self.refresh_gui()
+            self.storage.upgrade(on_progress)
             self.wallet = Wallet(self.storage)
             return self.wallet
 
@@ -36,7 +36,7 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-from electrum.util import bh2u, bfh
+from electrum.util import bh2u, bfh, LazyStr
 
 from electrum import keystore
 from electrum.bitcoin import COIN, is_address, TYPE_ADDRESS, NetworkConstants
@@ -1650,7 +1650,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
                     #self.update_send_tab()
                     self.do_proposal_clear()
                 else:
-                    self.print_error("raw tx : ", tx.serialize())
+                    self.print_error("raw tx : ", LazyStr(tx.serialize))
                     self.broadcast_transaction(tx, tx_desc)
                     self.do_proposal_clear()
         self.sign_tx_with_password(tx, sign_done, password)
@@ -2109,7 +2109,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
                     self.update_send_tab()
                     self.do_clear()
                 else:
-                    self.print_error("raw tx : ", tx.serialize())
+                    self.print_error("raw tx : ", LazyStr(tx.serialize))
                     self.broadcast_transaction(tx, tx_desc)
         self.sign_tx_with_password(tx, sign_done, password)
         self.passwd = None
@@ -2246,7 +2246,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
                     self.update_send_tab()
                     self.do_clear()
                 else:
-                    self.print_error("raw tx : ", tx.serialize())
+                    self.print_error("raw tx : ", LazyStr(tx.serialize))
                     self.broadcast_transaction(tx, tx_desc)
         self.sign_tx_with_password(tx, sign_done, password)
         self.passwd = None
@@ -2626,7 +2626,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
                     self.update_send_tab()
                     self.do_clear()
                 else:
-                    self.print_error("raw tx : ", tx.serialize())
+                    self.print_error("raw tx : ", LazyStr(tx.serialize))
                     self.broadcast_transaction(tx, tx_desc)
         self.sign_tx_with_password(tx, sign_done, password)
         self.passwd = None
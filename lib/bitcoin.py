@@ -32,6 +32,12 @@ import json
 import ecdsa
 import pyaes
 
+try:
+    # optional: bindings to libsecp256k1, much faster than python-ecdsa
+    import coincurve
+except ImportError:
+    coincurve = None
+
 from .util import bfh, bh2u, to_string
 from . import version
 from .util import print_error, InvalidPassword, assert_bytes, to_bytes, inv_dict
@@ -627,9 +633,9 @@ def verify_message(address, sig, message):
     assert_bytes(sig, message)
     try:
         h = Hash(msg_magic(message))
-        public_key, compressed = pubkey_from_signature(sig, h)
+        recid, compressed = decode_message_signature(sig)
+        pubkey = ecdsa_recover(sig[1:], recid, h, compressed)
         # check public key using the address
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
         for txin_type in ['p2pkh','p2wpkh','p2wpkh-p2sh']:
             addr = pubkey_to_address(txin_type, bh2u(pubkey))
             if address == addr:
@@ -637,7 +643,8 @@ def verify_message(address, sig, message):
         else:
             raise Exception("Bad signature")
         # check message
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not ecdsa_verify(pubkey, compact_to_der(sig[1:]), h):
+            raise Exception("Bad signature")
         return True
     except Exception as e:
         print_error("Verification error: {0}".format(e))
@@ -689,6 +696,101 @@ def ser_to_point(Aser):
     return Point( curve, Mx, ECC_YfromX(Mx, curve, Aser[0] == 0x03)[0], _r )
 
 
+def public_point(secret):
+    '''generator_secp256k1 * secret'''
+    if coincurve:
+        order = generator_secp256k1.order()
+        k = coincurve.PrivateKey(number_to_string(secret % order, order))
+        return ser_to_point(k.public_key.format(compressed=False))
+    return generator_secp256k1 * secret
+
+
+def ecdh(pubkey, secret):
+    '''Compressed serialization of the point pubkey * secret, where pubkey
+    is a serialized public key.  Raises ValueError if it is not valid.'''
+    if coincurve:
+        order = generator_secp256k1.order()
+        K = coincurve.PublicKey(pubkey)
+        return K.multiply(number_to_string(secret % order, order)).format(compressed=True)
+    try:
+        P = ser_to_point(pubkey)
+    except AssertionError:
+        raise ValueError('invalid pubkey')
+    if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, P.x(), P.y()):
+        raise ValueError('invalid pubkey')
+    return point_to_ser(P * secret)
+
+
+def tweak_public_key(pubkey, tweak, compressed=True):
+    '''Serialization of the point pubkey + tweak * G, where pubkey is a
+    serialized public key and tweak a 32-byte number.'''
+    if coincurve:
+        return coincurve.PublicKey(pubkey).add(tweak).format(compressed=compressed)
+    return point_to_ser(string_to_number(tweak) * generator_secp256k1 + ser_to_point(pubkey), compressed)
+
+
+def ecdsa_sign(secret, msg_hash):
+    '''Deterministic (RFC 6979) DER signature of a 32-byte hash, with a
+    low S value.'''
+    order = generator_secp256k1.order()
+    if coincurve:
+        k = coincurve.PrivateKey(number_to_string(secret % order, order))
+        return k.sign(msg_hash, hasher=None)
+    private_key = MySigningKey.from_secret_exponent(secret % order, curve=SECP256k1)
+    return private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_der)
+
+
+def ecdsa_verify(pubkey, sig, msg_hash):
+    '''Whether the DER signature sig of a 32-byte hash was made with the
+    key of the serialized public key pubkey.'''
+    order = generator_secp256k1.order()
+    try:
+        r, s = ecdsa.util.sigdecode_der(sig, order)
+        if coincurve:
+            # libsecp256k1 only accepts low S values
+            sig = ecdsa.util.sigencode_der(r, min(s, order - s), order)
+            return coincurve.PublicKey(pubkey).verify(sig, msg_hash, hasher=None)
+        public_key = ecdsa.ecdsa.Public_key(generator_secp256k1, ser_to_point(pubkey))
+        return public_key.verifies(string_to_number(msg_hash), ecdsa.ecdsa.Signature(r, s))
+    except Exception:
+        return False
+
+
+def ecdsa_sign_recoverable(secret, msg_hash):
+    '''The signature of ecdsa_sign in compact form (r || s), and the
+    recovery id of its public key.'''
+    order = generator_secp256k1.order()
+    if coincurve:
+        k = coincurve.PrivateKey(number_to_string(secret % order, order))
+        sig = k.sign_recoverable(msg_hash, hasher=None)
+        return sig[:64], sig[64]
+    private_key = MySigningKey.from_secret_exponent(secret % order, curve=SECP256k1)
+    sig = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_string)
+    pubkey = point_to_ser(public_point(secret), False)
+    for recid in range(4):
+        try:
+            if ecdsa_recover(sig, recid, msg_hash) == pubkey:
+                return sig, recid
+        except Exception:
+            continue
+    raise Exception("error: cannot sign message")
+
+
+def ecdsa_recover(sig, recid, msg_hash, compressed=False):
+    '''Serialized public key of the compact signature sig of a 32-byte
+    hash.'''
+    if coincurve:
+        K = coincurve.PublicKey.from_signature_and_message(sig + bytes([recid]), msg_hash, hasher=None)
+        return K.format(compressed=compressed)
+    public_key = MyVerifyingKey.from_signature(sig, recid, msg_hash, curve=SECP256k1)
+    return point_to_ser(public_key.pubkey.point, compressed)
+
+
+def compact_to_der(sig):
+    order = generator_secp256k1.order()
+    return ecdsa.util.sigencode_der(*ecdsa.util.sigdecode_string(sig, order), order)
+
+
 class MyVerifyingKey(ecdsa.VerifyingKey):
     @classmethod
     def from_signature(klass, sig, recid, h, curve):
@@ -717,7 +819,8 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         return klass.from_public_point( Q, curve )
 
 
-def pubkey_from_signature(sig, h):
+def decode_message_signature(sig):
+    '''Recovery id and compression flag of a signed message.'''
     if len(sig) != 65:
         raise Exception("Wrong encoding")
     nV = sig[0]
@@ -728,7 +831,11 @@ def pubkey_from_signature(sig, h):
         nV -= 4
     else:
         compressed = False
-    recid = nV - 27
+    return nV - 27, compressed
+
+
+def pubkey_from_signature(sig, h):
+    recid, compressed = decode_message_signature(sig)
     return MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1), compressed
 
 
@@ -749,7 +856,7 @@ class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, public_point(secret) )
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -757,34 +864,28 @@ class EC_KEY(object):
         return bh2u(point_to_ser(self.pubkey.point, compressed))
 
     def sign(self, msg_hash):
-        private_key = MySigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
-        return signature
+        order = generator_secp256k1.order()
+        signature = ecdsa_sign(self.secret, msg_hash)
+        assert ecdsa_verify(point_to_ser(self.pubkey.point), signature, msg_hash)
+        return ecdsa.util.sigencode_string(*ecdsa.util.sigdecode_der(signature, order), order)
 
     def sign_message(self, message, is_compressed):
         message = to_bytes(message, 'utf8')
-        signature = self.sign(Hash(msg_magic(message)))
-        for i in range(4):
-            sig = bytes([27 + i + (4 if is_compressed else 0)]) + signature
-            try:
-                self.verify_message(sig, message)
-                return sig
-            except Exception as e:
-                continue
-        else:
-            raise Exception("error: cannot sign message")
+        signature, recid = ecdsa_sign_recoverable(self.secret, Hash(msg_magic(message)))
+        sig = bytes([27 + recid + (4 if is_compressed else 0)]) + signature
+        self.verify_message(sig, message)
+        return sig
 
     def verify_message(self, sig, message):
         assert_bytes(message)
         h = Hash(msg_magic(message))
-        public_key, compressed = pubkey_from_signature(sig, h)
+        recid, compressed = decode_message_signature(sig)
         # check public key
-        if point_to_ser(public_key.pubkey.point, compressed) != point_to_ser(self.pubkey.point, compressed):
+        if ecdsa_recover(sig[1:], recid, h, compressed) != point_to_ser(self.pubkey.point, compressed):
             raise Exception("Bad signature")
         # check message
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not ecdsa_verify(point_to_ser(self.pubkey.point), compact_to_der(sig[1:]), h):
+            raise Exception("Bad signature")
 
 
     # ECIES encryption/decryption methods; AES-128-CBC with PKCS7 is used as the cipher; hmac-sha256 is used as the mac
@@ -793,13 +894,12 @@ class EC_KEY(object):
     def encrypt_message(self, message, pubkey):
         assert_bytes(message)
 
-        pk = ser_to_point(pubkey)
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, pk.x(), pk.y()):
-            raise Exception('invalid pubkey')
-
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        try:
+            ecdh_key = ecdh(pubkey, ephemeral.secret)
+        except ValueError:
+            raise Exception('invalid pubkey')
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -820,12 +920,9 @@ class EC_KEY(object):
         if magic != b'BIE1':
             raise Exception('invalid ciphertext: invalid magic bytes')
         try:
-            ephemeral_pubkey = ser_to_point(ephemeral_pubkey)
-        except AssertionError as e:
+            ecdh_key = ecdh(ephemeral_pubkey, self.secret)
+        except ValueError:
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
-            raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -841,10 +938,9 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    P = public_point(string_to_number(secret))
+    K = point_to_ser(P, False)[1:]
+    K_compressed = point_to_ser(P, True)
     return K, K_compressed
 
 
@@ -863,9 +959,7 @@ def CKD_priv(k, c, n):
 
 def _CKD_priv(k, c, s, is_prime):
     order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
-    data = bytes([0]) + k + s if is_prime else cK + s
+    data = bytes([0]) + k + s if is_prime else point_to_ser(public_point(string_to_number(k))) + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
     c_n = I[32:]
@@ -883,13 +977,9 @@ def CKD_pub(cK, c, n):
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
+    cK_n = tweak_public_key(cK, I[0:32])
     return cK_n, c_n
 
 
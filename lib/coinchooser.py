@@ -161,10 +161,10 @@ class CoinChooserBase(PrintError):
         return ret_addr
 
     def change_outputs(self, tx, change_addrs, fee_estimator, dust_threshold):
-        # get max value address
-        change_addr = self.get_change_address(tx.inputs())
-        change_addrs = [change_addr]
-        
+        if not change_addrs:
+            # get max value address
+            change_addrs = [self.get_change_address(tx.inputs())]
+
         amounts = self.change_amounts(tx, len(change_addrs), fee_estimator,
                                       dust_threshold)
         assert min(amounts) >= 0
@@ -176,7 +176,7 @@ class CoinChooserBase(PrintError):
         change = [(TYPE_ADDRESS, addr, amount)
                   for addr, amount in zip(change_addrs, amounts)]
         self.print_error('change:', change)
-        self.print_error('change:', tx.inputs())
+        self.print_debug('change:', tx.inputs())
 
         if dust:
             self.print_error('not keeping dust', dust)
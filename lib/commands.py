@@ -143,6 +143,19 @@ class Commands:
         self.wallet.storage.write()
         return {'password':self.wallet.has_password()}
 
+    @command('w')
+    def setstorageformat(self, storage_format):
+        """Set the format of the wallet file. 'json' writes the whole wallet
+        as one document, 'log' appends the changed keys on each save,
+        'stream' writes encrypted wallets in bounded memory, in a format
+        that older versions cannot read."""
+        if storage_format not in ['json', 'log', 'stream']:
+            raise BaseException('Unknown storage format: %s' % storage_format)
+        self.wallet.storage.set_log_format(storage_format == 'log')
+        self.wallet.storage.set_stream_encryption(storage_format == 'stream')
+        self.wallet.storage.write()
+        return True
+
     @command('')
     def getconfig(self, key):
         """Return a configuration variable. """
@@ -249,8 +262,20 @@ class Commands:
     def deserialize(self, tx):
         """Deserialize a serialized transaction"""
         tx = Transaction(tx)
+        if tx.raw is None:
+            # partial transaction format
+            tx = Transaction(tx.serialize())
         return tx.deserialize()
 
+    @command('')
+    def convertpartial(self, tx):
+        """Convert a transaction to the partial transaction format, or a
+        partial transaction back to the usual format. Both are in hex."""
+        tx = Transaction(tx)
+        if tx.raw is None:
+            return tx.serialize()
+        return tx.serialize_partial()
+
     @command('n')
     def broadcast(self, tx, timeout=30):
         """Broadcast a transaction to the network. """
@@ -452,6 +477,26 @@ class Commands:
         tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, rbf, password, locktime)
         return tx.as_dict()
 
+    @command('wp')
+    def paytobatch(self, outputs, fee=None, from_addr=None, change_addr=None, max_outputs=None, nocheck=False, unsigned=False, rbf=False, password=None):
+        """Create the transactions of a payout to many outputs, with at most max_outputs outputs each. They are returned in the order they must be broadcast, as later ones may spend the change of earlier ones."""
+        self.nocheck = nocheck
+        tx_fee = satoshis(fee)
+        domain = from_addr.split(',') if from_addr else None
+        change_addr = self._resolver(change_addr)
+        domain = None if domain is None else map(self._resolver, domain)
+        final_outputs = [(TYPE_ADDRESS, self._resolver(address), satoshis(amount)) for address, amount in outputs]
+        coins = self.wallet.get_spendable_coins(domain, self.config)
+
+        def sign(txs):
+            for tx in txs:
+                run_hook('sign_tx', self.wallet, tx)
+            self.wallet.sign_transactions(txs, password)
+
+        txs = self.wallet.make_batch_transactions(coins, final_outputs, self.config, tx_fee, change_addr,
+                                                  max_outputs, rbf, None if unsigned else sign)
+        return [tx.as_dict() for tx in txs]
+
     @command('w')
     def history(self):
         """Wallet history. Returns the transaction history of your wallet."""
@@ -464,8 +509,7 @@ class Commands:
             else:
                 date = "----"
             label = self.wallet.get_label(tx_hash)
-            tx = self.wallet.transactions.get(tx_hash)
-            tx.deserialize()
+            tx = self.wallet.get_transaction(tx_hash)
             input_addresses = []
             output_addresses = []
             for x in tx.inputs():
@@ -548,7 +592,7 @@ class Commands:
     def gettransaction(self, txid):
         """Retrieve a transaction. """
         if self.wallet and txid in self.wallet.transactions:
-            tx = self.wallet.transactions[txid]
+            tx = self.wallet.get_transaction(txid)
         else:
             raw = self.network.synchronous_get(('blockchain.transaction.get', [txid]))
             if raw:
@@ -690,7 +734,7 @@ param_descriptions = {
     'txid': 'Transaction ID',
     'pos': 'Position',
     'height': 'Block height',
-    'tx': 'Serialized transaction (hexadecimal)',
+    'tx': 'Serialized transaction or partial transaction (hexadecimal)',
     'key': 'Variable name',
     'pubkey': 'Public key',
     'message': 'Clear text message. Use quotes if it contains spaces.',
@@ -699,6 +743,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in LBTC).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'storage_format': 'Wallet file format: json, log or stream',
 }
 
 command_options = {
@@ -713,6 +758,7 @@ command_options = {
     'labels':      ("-l", "Show the labels of listed addresses"),
     'nocheck':     (None, "Do not verify aliases"),
     'imax':        (None, "Maximum number of inputs"),
+    'max_outputs': (None, "Maximum number of outputs per transaction"),
     'fee':         ("-f", "Transaction fee (in LBTC)"),
     'from_addr':   ("-F", "Source address (must be a wallet address; use sweep to spend from non-wallet address)."),
     'change_addr': ("-c", "Change address. Default is a spare address, or the source address if it's not in the wallet"),
@@ -742,6 +788,7 @@ arg_types = {
     'num': int,
     'nbits': int,
     'imax': int,
+    'max_outputs': int,
     'entropy': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
@@ -825,12 +872,19 @@ def add_network_options(parser):
 
 def add_global_options(parser):
     group = parser.add_argument_group('global options')
-    group.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False, help="Show debugging information")
+    group.add_argument("-v", "--verbose", action="count", dest="verbose", default=0, help="Show debugging information, -vv for details of each signature")
     group.add_argument("-D", "--dir", dest="electrum_path", help="electrum directory")
     group.add_argument("-P", "--portable", action="store_true", dest="portable", default=False, help="Use local 'electrum_data' directory")
     group.add_argument("-w", "--wallet", dest="wallet_path", help="wallet path")
     group.add_argument("--testnet", action="store_true", dest="testnet", default=False, help="Use Testnet")
 
+def get_verbosity(config_options):
+    '''Verbosity level of the command line options: the number of -v.'''
+    # kivy sometimes freezes when we write to sys.stderr
+    if config_options.get('gui') == 'kivy':
+        return 0
+    return int(config_options.get('verbose', 0))
+
 def get_parser():
     # create main parser
     parser = argparse.ArgumentParser(
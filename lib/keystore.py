@@ -29,7 +29,7 @@ from unicodedata import normalize
 from . import bitcoin
 from .bitcoin import *
 
-from .util import PrintError, InvalidPassword, hfu
+from .util import PrintError, InvalidPassword, hfu, print_debug, LazyStr
 from .mnemonic import Mnemonic, load_wordlist
 from .plugins import run_hook
 
@@ -75,6 +75,9 @@ class KeyStore(PrintError):
 
 class Software_KeyStore(KeyStore):
 
+    # worker processes used to sign the inputs of a transaction
+    sign_processes = 0
+
     def __init__(self):
         KeyStore.__init__(self)
 
@@ -94,11 +97,8 @@ class Software_KeyStore(KeyStore):
         #print_error("prikey:", privkey)
         #print_error("prehash:", bh2u(pre_hash))
         pkey = regenerate_key(privkey)
-        secexp = pkey.secret
-        private_key = bitcoin.MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-        assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
+        sig = bitcoin.ecdsa_sign(pkey.secret, pre_hash)
+        assert bitcoin.ecdsa_verify(bfh(pkey.get_public_key()), sig, pre_hash)
         return bh2u(sig)
         
     def decrypt_message(self, sequence, message, password):
@@ -118,7 +118,7 @@ class Software_KeyStore(KeyStore):
             keypairs[k] = self.get_private_key(v, password)
         # Sign
         if keypairs:
-            tx.sign(keypairs)
+            tx.sign(keypairs, self.sign_processes)
 
 
 class Imported_KeyStore(Software_KeyStore):
@@ -177,15 +177,11 @@ class Imported_KeyStore(Software_KeyStore):
         #sec = pw_decode(self.keypairs[pubkey], password)
         privkey, compressed = self.get_private_key(pubkey, password)
         pre_hash = Hash(bfh(message))
-        print_error("pubkey:", pubkey)
-        print_error("prikey:", privkey)
-        print_error("prehash:", bh2u(pre_hash))
+        print_debug("pubkey:", pubkey)
+        print_debug("prehash:", LazyStr(bh2u, pre_hash))
         pkey = regenerate_key(privkey)
-        secexp = pkey.secret
-        private_key = bitcoin.MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-        assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
+        sig = bitcoin.ecdsa_sign(pkey.secret, pre_hash)
+        assert bitcoin.ecdsa_verify(bfh(pkey.get_public_key()), sig, pre_hash)
         return bh2u(sig)
 
     def get_pubkey_derivation(self, x_pubkey):
@@ -247,17 +243,43 @@ class Deterministic_KeyStore(Software_KeyStore):
         return pw_decode(self.passphrase, password) if self.passphrase else ''
 
 
+def _derive_pubkeys(xpub, start, count):
+    _, _, _, _, c, cK = deserialize_xpub(xpub)
+    return [bh2u(CKD_pub(cK, c, n)[0]) for n in range(start, start + count)]
+
+
+def derive_pubkeys_from_xpub(xpub, start, count, processes=0):
+    '''Child pubkeys start..start+count-1 of xpub.  With processes > 1
+    the range is split across a pool of worker processes.'''
+    if processes <= 1 or count < 2 * processes:
+        return _derive_pubkeys(xpub, start, count)
+    from concurrent.futures import ProcessPoolExecutor
+    chunk = -(-count // processes)
+    starts = range(start, start + count, chunk)
+    counts = [min(chunk, start + count - s) for s in starts]
+    with ProcessPoolExecutor(processes) as pool:
+        results = pool.map(_derive_pubkeys, [xpub] * len(counts), starts, counts)
+    return [pubkey for r in results for pubkey in r]
+
+
+# pubkeys derived by get_pubkey_from_xpub, for x_pubkeys of transactions
+_xpub_pubkeys = {}
+
+
 class Xpub:
 
     def __init__(self):
         self.xpub = None
         self.xpub_receive = None
         self.xpub_change = None
+        # decoded (c, cK) of the sequence xpubs, and pubkeys by (for_change, n)
+        self.sequence_nodes = {}
+        self.pubkeys = {}
 
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
+    def get_sequence_xpub(self, for_change):
         xpub = self.xpub_change if for_change else self.xpub_receive
         if xpub is None:
             xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
@@ -265,14 +287,56 @@ class Xpub:
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        return xpub
+
+    def get_sequence_node(self, for_change):
+        node = self.sequence_nodes.get(for_change)
+        if node is None:
+            _, _, _, _, c, cK = deserialize_xpub(self.get_sequence_xpub(for_change))
+            node = self.sequence_nodes[for_change] = (c, cK)
+        return node
+
+    def derive_pubkey(self, for_change, n):
+        pubkey = self.pubkeys.get((for_change, n))
+        if pubkey is None:
+            c, cK = self.get_sequence_node(for_change)
+            pubkey = self.pubkeys[(for_change, n)] = bh2u(CKD_pub(cK, c, n)[0])
+        return pubkey
+
+    def derive_pubkeys(self, for_change, start, count, processes=0):
+        keys = [(for_change, n) for n in range(start, start + count)]
+        if any(key not in self.pubkeys for key in keys):
+            xpub = self.get_sequence_xpub(for_change)
+            pubkeys = derive_pubkeys_from_xpub(xpub, start, count, processes)
+            self.pubkeys.update(zip(keys, pubkeys))
+        return [self.pubkeys[key] for key in keys]
+
+    def get_pubkey_cache(self):
+        '''Derived pubkeys of both chains, from index 0 up to the first
+        one that was not derived.'''
+        chains = [[], []]
+        for for_change, l in enumerate(chains):
+            while (for_change, len(l)) in self.pubkeys:
+                l.append(self.pubkeys[(for_change, len(l))])
+        return chains
+
+    def load_pubkey_cache(self, chains):
+        for for_change, l in enumerate(chains):
+            self.pubkeys.update(((for_change, n), pubkey) for n, pubkey in enumerate(l))
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
-        _, _, _, _, c, cK = deserialize_xpub(xpub)
-        for i in sequence:
-            cK, c = CKD_pub(cK, c, i)
-        return bh2u(cK)
+        key = (xpub, tuple(sequence))
+        pubkey = _xpub_pubkeys.get(key)
+        if pubkey is None:
+            _, _, _, _, c, cK = deserialize_xpub(xpub)
+            for i in sequence:
+                cK, c = CKD_pub(cK, c, i)
+            pubkey = bh2u(cK)
+            if len(_xpub_pubkeys) > 10000:
+                _xpub_pubkeys.clear()
+            _xpub_pubkeys[key] = pubkey
+        return pubkey
 
     def get_xpubkey(self, c, i):
         s = ''.join(map(lambda x: bitcoin.int_to_hex(x,2), (c, i)))
@@ -409,8 +473,7 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def mpk_from_seed(klass, seed):
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = point_to_ser(public_point(secexp), False)[1:]
         return bh2u(master_public_key)
 
     @classmethod
@@ -426,15 +489,16 @@ class Old_KeyStore(Deterministic_KeyStore):
 
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
+        order = generator_secp256k1.order()
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string(bfh(mpk), curve = SECP256k1)
-        pubkey_point = master_public_key.pubkey.point + z*SECP256k1.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point(pubkey_point, curve = SECP256k1)
-        return '04' + bh2u(public_key2.to_string())
+        return bh2u(tweak_public_key(bfh('04' + mpk), number_to_string(z % order, order), False))
 
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, start, count, processes=0):
+        return [self.derive_pubkey(for_change, n) for n in range(start, start + count)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
@@ -451,8 +515,7 @@ class Old_KeyStore(Deterministic_KeyStore):
 
     def check_seed(self, seed):
         secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = point_to_ser(public_point(secexp), False)[1:]
         if master_public_key != bfh(self.mpk):
             print_error('invalid password (mpk)', self.mpk, bh2u(master_public_key))
             raise InvalidPassword()
@@ -25,15 +25,16 @@
 import os
 import ast
 import threading
+import time
 import json
 import copy
 import re
 import stat
-import pbkdf2, hmac, hashlib
+import hmac, hashlib
 import base64
 import zlib
 
-from .util import PrintError, profiler
+from .util import PrintError, profiler, InvalidPassword, bfh
 from .plugins import run_hook, plugin_loaders
 from .keystore import bip44_derivation
 from . import bitcoin
@@ -43,9 +44,26 @@ from . import bitcoin
 
 OLD_SEED_VERSION = 4        # electrum versions < 2.0
 NEW_SEED_VERSION = 11       # electrum versions >= 2.0
-FINAL_SEED_VERSION = 16     # electrum >= 2.7 will set this to prevent
+FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+# first line of a wallet file stored as an append-only log. Each following
+# line is a record of the top-level keys changed by one write (null for
+# removed keys); the file is compacted into a single record when it has
+# grown to LOG_COMPACT_RATIO times the size of its last snapshot.
+LOG_MAGIC = 'electrum-log 1'
+LOG_COMPACT_RATIO = 2
+
+# encrypted wallet files can be written and read in bounded memory: the
+# magic, the ephemeral public key, then records of
+#   length (4 bytes) | final flag (1 byte) | AES-CBC ciphertext | HMAC-SHA256
+# whose plaintext is a zlib stream of JSON objects, one per line, each
+# holding one top-level key.  Dicts are split over lines of at most
+# STREAM_LINE_ITEMS items, which are merged when read.  Encrypted files
+# are otherwise a single encrypted JSON document (BIE1).
+STREAM_MAGIC = b'BIE2'
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_LINE_ITEMS = 1000
 
 
 def multisig_type(wallet_type):
@@ -66,26 +84,64 @@ class WalletStorage(PrintError):
         self.data = {}
         self.path = path
         self.modified = False
+        # top-level keys changed since the last write
+        self.dirty_keys = set()
+        # digests of the serialized values of top-level keys, as of their
+        # last put(); the text itself is not kept
+        self.digests = {}
+        self.autosave_delay = 0
+        self.autosave_callback = None
+        self.autosave_timer = None
+        # locks held, in this order, by the owner of the shared values
+        # while it changes them, and the keys of those values
+        self.shared_locks = []
+        self.shared_keys = set()
+        # compact texts of the shared values, taken for the current write
+        self.snapshot = {}
+        self.write_stats = {'writes': 0, 'bytes': 0, 'seconds': 0.}
         self.pubkey = None
+        # (salted hash of the password, key) that last decrypted the file
+        self.key_cache = None
+        self.key_salt = os.urandom(16)
+        self.log_format = False
+        self.log_size = 0
+        self.log_snapshot_size = 0
+        self.stream_format = False
+        # write encrypted files as a stream; kept from the file read
+        self.stream_encryption = False
+        self.upgrade_callback = None
+        self.upgrade_step = 0
         if self.file_exists():
-            with open(self.path, "r") as f:
-                self.raw = f.read()
+            with open(self.path, "rb") as f:
+                self.stream_format = f.read(len(STREAM_MAGIC)) == STREAM_MAGIC
+            self.stream_encryption = self.stream_format
+            # streamed files are only read when decrypted
+            self.raw = ''
+            if not self.stream_format:
+                with open(self.path, "r") as f:
+                    self.raw = f.read()
+            if self.raw.startswith(LOG_MAGIC + '\n'):
+                self.log_format = True
+                self.log_size = len(self.raw)
+                self.log_snapshot_size = len(self.raw.split('\n', 2)[1]) + len(LOG_MAGIC) + 2
             if not self.is_encrypted():
                 self.load_data(self.raw)
+                # the text is only needed again to decrypt
+                self.raw = ''
         else:
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
     def load_data(self, s):
         try:
-            self.data = json.loads(s)
+            data = self.read_log(s) if self.log_format else json.loads(s)
         except:
             try:
                 d = ast.literal_eval(s)
                 labels = d.get('labels', {})
             except Exception as e:
                 raise IOError("Cannot read wallet file '%s'" % self.path)
-            self.data = {}
+            data = {}
             for key, value in d.items():
                 try:
                     json.dumps(key)
@@ -93,7 +149,13 @@ class WalletStorage(PrintError):
                 except:
                     self.print_error('Failed to convert label to json format', key)
                     continue
-                self.data[key] = value
+                data[key] = value
+        self.init_data(data)
+
+    def init_data(self, data):
+        self.data = data
+        self.digests = {}
+        self.shared_keys = set()
 
         # check here if I need to load a plugin
         t = self.get('wallet_type')
@@ -106,64 +168,384 @@ class WalletStorage(PrintError):
             if self.requires_upgrade():
                 self.upgrade()
 
+    def read_log(self, s):
+        data = {}
+        records = [line for line in s.split('\n')[1:] if line]
+        for i, line in enumerate(records):
+            try:
+                d = json.loads(line)
+            except ValueError:
+                # a write interrupted while appending leaves a partial last record
+                if i == len(records) - 1 and i > 0:
+                    self.print_error('ignoring truncated record in', self.path)
+                    # appending after it would corrupt the next record
+                    self.log_size = 0
+                    break
+                raise
+            for key, value in d.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+        return data
+
     def is_encrypted(self):
+        if self.stream_format:
+            return True
+        s = self.raw.split('\n')[1] if self.log_format and self.raw else self.raw
         try:
-            return base64.b64decode(self.raw)[0:4] == b'BIE1'
+            return base64.b64decode(s)[0:4] == b'BIE1'
         except:
             return False
 
     def file_exists(self):
         return self.path and os.path.exists(self.path)
 
+    def password_hash(self, password):
+        return hmac.new(self.key_salt, password.encode('utf8'), hashlib.sha256).digest()
+
     def get_key(self, password):
-        secret = pbkdf2.PBKDF2(password, '', iterations = 1024, macmodule = hmac, digestmodule = hashlib.sha512).read(64)
-        ec_key = bitcoin.EC_KEY(secret)
-        return ec_key
+        if self.key_cache and hmac.compare_digest(self.key_cache[0], self.password_hash(password)):
+            return self.key_cache[1]
+        secret = hashlib.pbkdf2_hmac('sha512', password.encode('utf8'), b'', 1024, 64)
+        return bitcoin.EC_KEY(secret)
 
     def decrypt(self, password):
         ec_key = self.get_key(password)
-        s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
+        if self.stream_format:
+            data = self.read_stream(ec_key)
+        elif self.log_format:
+            s = self.decrypt_log(ec_key)
+        else:
+            s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
+            s = s.decode('utf8')
+        # only a key that decrypted the file is kept
+        self.key_cache = (self.password_hash(password), ec_key)
         self.pubkey = ec_key.get_public_key()
-        s = s.decode('utf8')
-        self.load_data(s)
+        if self.stream_format:
+            self.init_data(data)
+        else:
+            self.load_data(s)
+
+    def stream_keys(self, ephemeral_pubkey, secret):
+        key = hashlib.sha512(bitcoin.ecdh(ephemeral_pubkey, secret)).digest()
+        return key[16:32], key[32:]
+
+    def stream_iv(self, key_m, index):
+        return hmac.new(key_m, b'iv' + index.to_bytes(4, 'big'), hashlib.sha256).digest()[0:16]
+
+    def read_stream(self, ec_key):
+        data = {}
+        with open(self.path, "rb") as f:
+            header = f.read(len(STREAM_MAGIC) + 33)
+            key_e, key_m = self.stream_keys(header[len(STREAM_MAGIC):], ec_key.secret)
+            z = zlib.decompressobj()
+            pending = []
+            index = 0
+            final = False
+            while not final:
+                prefix = f.read(5)
+                length = int.from_bytes(prefix[0:4], 'big')
+                ciphertext = f.read(length)
+                mac = f.read(32)
+                if len(prefix) < 5 or len(mac) < 32:
+                    raise IOError("Wallet file '%s' is truncated" % self.path)
+                if mac != hmac.new(key_m, header + index.to_bytes(4, 'big') + prefix + ciphertext, hashlib.sha256).digest():
+                    if index == 0:
+                        raise InvalidPassword()
+                    raise IOError("Wallet file '%s' is corrupted" % self.path)
+                final = prefix[4] == 1
+                chunk = z.decompress(bitcoin.aes_decrypt_with_iv(key_e, self.stream_iv(key_m, index), ciphertext))
+                if final:
+                    chunk += z.flush()
+                # a line can span many records
+                lines = chunk.split(b'\n')
+                for line in lines[:-1]:
+                    pending.append(line)
+                    for key, value in json.loads(b''.join(pending).decode('utf8')).items():
+                        if isinstance(value, dict) and isinstance(data.get(key), dict):
+                            data[key].update(value)
+                        else:
+                            data[key] = value
+                    pending = []
+                pending.append(lines[-1])
+                index += 1
+        return data
+
+    def write_stream(self, f):
+        ephemeral = bitcoin.EC_KEY(os.urandom(32))
+        header = STREAM_MAGIC + bfh(ephemeral.get_public_key())
+        key_e, key_m = self.stream_keys(bfh(self.pubkey), ephemeral.secret)
+        f.write(header)
+        size = len(header)
+        index = 0
+        z = zlib.compressobj()
+        pending = []
+        pending_size = 0
+
+        def write_record(final):
+            nonlocal size, index, pending, pending_size
+            ciphertext = bitcoin.aes_encrypt_with_iv(key_e, self.stream_iv(key_m, index), b''.join(pending))
+            prefix = len(ciphertext).to_bytes(4, 'big') + bytes([final])
+            mac = hmac.new(key_m, header + index.to_bytes(4, 'big') + prefix + ciphertext, hashlib.sha256).digest()
+            f.write(prefix + ciphertext + mac)
+            size += len(prefix) + len(ciphertext) + len(mac)
+            index += 1
+            pending = []
+            pending_size = 0
+
+        def parts():
+            for key in sorted(self.data.keys()):
+                for s in self.value_chunks(key):
+                    yield '{%s: ' % json.dumps(key)
+                    for i in range(0, len(s), STREAM_CHUNK_SIZE):
+                        yield s[i:i + STREAM_CHUNK_SIZE]
+                    yield '}\n'
+
+        for part in parts():
+            chunk = z.compress(part.encode('utf8'))
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= STREAM_CHUNK_SIZE:
+                write_record(False)
+        pending.append(z.flush())
+        write_record(True)
+        return size
+
+    def decrypt_log(self, ec_key):
+        lines = [LOG_MAGIC]
+        records = [line for line in self.raw.split('\n')[1:] if line]
+        for i, line in enumerate(records):
+            try:
+                line = zlib.decompress(ec_key.decrypt_message(line)).decode('utf8')
+            except Exception:
+                if i == len(records) - 1 and i > 0:
+                    self.print_error('ignoring truncated record in', self.path)
+                    # appending after it would corrupt the next record
+                    self.log_size = 0
+                    break
+                raise
+            lines.append(line)
+        return '\n'.join(lines)
 
     def set_password(self, password, encrypt):
+        self.key_cache = None
         self.put('use_encryption', bool(password))
         if encrypt and password:
             ec_key = self.get_key(password)
             self.pubkey = ec_key.get_public_key()
         else:
             self.pubkey = None
+        # records encrypted with the previous key must not remain in the log
+        self.log_size = 0
+        self.modified = True
 
-    def get(self, key, default=None):
+    def set_log_format(self, log_format):
+        '''Store the file as an append-only log of changed keys, or as a
+        single JSON document.  Takes effect on the next write.'''
+        with self.lock:
+            self.log_format = log_format
+            self.log_size = 0
+            self.modified = True
+
+    def set_stream_encryption(self, stream_encryption):
+        '''Write the file, when it is encrypted, as a stream of records
+        read and written in bounded memory, instead of as one encrypted
+        document.  Takes effect on the next write.'''
+        with self.lock:
+            self.stream_encryption = stream_encryption
+            self.modified = True
+
+    def get(self, key, default=None, shared=False):
+        '''With shared=True the stored object itself is returned instead of
+        a copy.  Changes made to it are saved once it is passed to put()
+        again.  Copies are made through JSON, so that they have the types
+        they are read back with, whatever the wallet keeps in memory.'''
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
+            elif shared:
+                self.shared_keys.add(key)
             else:
-                v = copy.deepcopy(v)
+                v = json.loads(self.serialize(v))
         return v
 
-    def put(self, key, value):
+    def put(self, key, value, shared=False):
+        '''With shared=True the value is stored without being copied, and
+        the caller may keep using it; see get().'''
         try:
             json.dumps(key)
-            json.dumps(value)
+            s = self.serialize(value)
         except:
             self.print_error("json error: cannot save", key)
             return
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
+                digest = self.digest(s)
+                if key in self.digests:
+                    changed = self.digests[key] != digest
+                else:
+                    # a shared object may have changed since it was loaded
+                    changed = value is self.data.get(key) or self.data.get(key) != value
+                if changed:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    self.dirty_keys.add(key)
+                    self.data[key] = value if shared else copy.deepcopy(value)
+                    self.schedule_autosave()
+                elif shared:
+                    self.data[key] = value
+                if shared:
+                    self.shared_keys.add(key)
+                else:
+                    self.shared_keys.discard(key)
+                self.digests[key] = digest
             elif key in self.data:
                 self.modified = True
+                self.dirty_keys.add(key)
                 self.data.pop(key)
+                self.digests.pop(key, None)
+                self.schedule_autosave()
+
+    def replace(self, key, value):
+        '''Keep value, which must serialize like the stored value of key,
+        in place of it, without marking the key as changed.  Used to hand
+        the storage a compacted form of a table it loaded.'''
+        s = self.serialize(value)
+        with self.lock:
+            self.data[key] = value
+            self.shared_keys.add(key)
+            self.digests[key] = self.digest(s)
+
+    def set_data(self, data):
+        with self.lock:
+            self.data = data
+            self.digests = {}
+            self.shared_keys = set()
+            self.modified = True
+
+    def serialize(self, value):
+        return json.dumps(value, sort_keys=True)
+
+    def digest(self, s):
+        return hashlib.sha256(s.encode('utf8')).digest()
+
+    def chunk_texts(self, value):
+        # dicts are split, so that no text holds a whole table
+        if isinstance(value, dict) and value:
+            items = list(value.items())
+            return [self.serialize(dict(items[i:i + STREAM_LINE_ITEMS]))
+                    for i in range(0, len(items), STREAM_LINE_ITEMS)]
+        return [self.serialize(value)]
+
+    def value_chunks(self, key):
+        '''Compact JSON texts of the value of key, split as by chunk_texts.
+        Shared values are taken from the snapshot of the current write.'''
+        texts = self.snapshot.get(key)
+        return texts if texts is not None else self.chunk_texts(self.data[key])
+
+    def value_text(self, key):
+        texts = self.snapshot.get(key)
+        if texts is None:
+            return self.serialize(self.data[key])
+        # the chunks of a dict, joined into one object
+        return texts[0] if len(texts) == 1 else '{' + ', '.join(t[1:-1] for t in texts) + '}'
+
+    def get_indented_text(self, key):
+        # json only uses its C encoder without indent; the indented text
+        # is made from its output
+        value = json.loads(self.value_text(key))
+        return json.dumps(value, indent=4, sort_keys=True).replace('\n', '\n    ')
+
+    def set_autosave(self, delay, callback=None):
+        '''Save changes at most `delay` seconds after they are made, from a
+        writer thread.  callback is run before each autosave, to put
+        values that are kept outside of the storage.  A delay of 0 turns
+        autosave off.'''
+        with self.lock:
+            self.autosave_delay = delay
+            self.autosave_callback = callback
+            timer = self.autosave_timer
+            self.autosave_timer = None
+        if timer:
+            timer.cancel()
+            # an autosave that has started is finished
+            if timer is not threading.current_thread():
+                timer.join()
+
+    def set_shared_locks(self, locks):
+        '''Locks that the owner of the shared values holds, in this order,
+        while it changes them.  Writes hold them while the shared values
+        are serialized.'''
+        self.shared_locks = locks
+
+    def schedule_autosave(self):
+        with self.lock:
+            if not self.autosave_delay or self.autosave_timer:
+                return
+            self.autosave_timer = threading.Timer(self.autosave_delay, self._autosave)
+            # Timer inherits the daemon flag of its creator, and _write
+            # refuses to run in daemon threads
+            self.autosave_timer.daemon = False
+            self.autosave_timer.start()
+
+    def _autosave(self):
+        with self.lock:
+            if self.autosave_timer is not threading.current_thread():
+                # cancelled
+                return
+            self.autosave_timer = None
+            callback = self.autosave_callback
+        # outside of our lock: the callback takes the wallet locks
+        if callback:
+            callback()
+        self._write_shared()
+
+    def get_write_stats(self):
+        with self.lock:
+            return dict(self.write_stats)
+
+    def _update_write_stats(self, size, start_time):
+        self.write_stats['writes'] += 1
+        self.write_stats['bytes'] += size
+        self.write_stats['seconds'] += time.time() - start_time
 
     @profiler
     def write(self):
-        with self.lock:
+        self._write_shared()
+
+    def _write_shared(self):
+        # the shared locks come before ours, as their owner puts values
+        # while holding them; they are released once the shared values
+        # are serialized
+        for lock in self.shared_locks:
+            lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                self.take_snapshot()
+            except BaseException:
+                self.lock.release()
+                raise
+        finally:
+            for lock in reversed(self.shared_locks):
+                lock.release()
+        try:
             self._write()
+        finally:
+            self.snapshot = {}
+            self.lock.release()
+
+    def take_snapshot(self):
+        if not self.modified or threading.currentThread().isDaemon():
+            return
+        keys = self.dirty_keys if self.appends() else self.data.keys()
+        for key in self.shared_keys.intersection(keys):
+            if key in self.data:
+                self.snapshot[key] = self.chunk_texts(self.data[key])
+
+    def appends(self):
+        return self.log_format and 0 < self.log_size < LOG_COMPACT_RATIO * self.log_snapshot_size
 
     def _write(self):
         if threading.currentThread().isDaemon():
@@ -171,18 +553,35 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True)
-        if self.pubkey:
-            s = bytes(s, 'utf8')
-            c = zlib.compress(s)
-            s = bitcoin.encrypt_message(c, self.pubkey)
-            s = s.decode('utf8')
+        start_time = time.time()
+        if self.appends():
+            self._append_record(start_time)
+            return
+        if self.log_format:
+            pieces = [LOG_MAGIC + '\n', self.encode_record(self.data.keys()), '\n']
+        elif self.pubkey and self.stream_encryption:
+            pieces = None
+        elif self.pubkey:
+            s = ''.join(self.json_pieces())
+            c = zlib.compress(bytes(s, 'utf8'))
+            pieces = [bitcoin.encrypt_message(c, self.pubkey).decode('utf8')]
+        else:
+            pieces = self.json_pieces()
 
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        with open(temp_path, "w") as f:
-            f.write(s)
-            f.flush()
-            os.fsync(f.fileno())
+        if pieces is None:
+            with open(temp_path, "wb") as f:
+                size = self.write_stream(f)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            size = 0
+            with open(temp_path, "w") as f:
+                for piece in pieces:
+                    f.write(piece)
+                    size += len(piece)
+                f.flush()
+                os.fsync(f.fileno())
 
         mode = os.stat(self.path).st_mode if os.path.exists(self.path) else stat.S_IREAD | stat.S_IWRITE
         # perform atomic write on POSIX systems
@@ -194,6 +593,42 @@ class WalletStorage(PrintError):
         os.chmod(self.path, mode)
         self.print_error("saved", self.path)
         self.modified = False
+        self.dirty_keys = set()
+        self.stream_format = pieces is None
+        self.log_size = self.log_snapshot_size = size
+        self._update_write_stats(size, start_time)
+
+    def json_pieces(self):
+        '''Same text as json.dumps(self.data, indent=4, sort_keys=True), one
+        value at a time, so that it is written without being held whole.'''
+        if not self.data:
+            yield '{}'
+            return
+        sep = '{\n'
+        for key in sorted(self.data.keys()):
+            yield sep + '    %s: ' % json.dumps(key)
+            yield self.get_indented_text(key)
+            sep = ',\n'
+        yield '\n}'
+
+    def encode_record(self, keys):
+        s = '{' + ', '.join('%s: %s' % (json.dumps(key), self.value_text(key) if key in self.data else 'null')
+                            for key in sorted(keys)) + '}'
+        if self.pubkey:
+            s = bitcoin.encrypt_message(zlib.compress(bytes(s, 'utf8')), self.pubkey).decode('utf8')
+        return s
+
+    def _append_record(self, start_time):
+        s = self.encode_record(self.dirty_keys) + '\n'
+        with open(self.path, "a") as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        self.print_error("appended %d keys to" % len(self.dirty_keys), self.path)
+        self.modified = False
+        self.dirty_keys = set()
+        self.log_size += len(s)
+        self._update_write_stats(len(s), start_time)
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -209,12 +644,12 @@ class WalletStorage(PrintError):
         if wallet_type == 'old':
             assert len(d) == 2
             storage1 = WalletStorage(storage.path + '.deterministic')
-            storage1.data = copy.deepcopy(storage.data)
+            storage1.set_data(copy.deepcopy(storage.data))
             storage1.put('accounts', {'0': d['0']})
             storage1.upgrade()
             storage1.write()
             storage2 = WalletStorage(storage.path + '.imported')
-            storage2.data = copy.deepcopy(storage.data)
+            storage2.set_data(copy.deepcopy(storage.data))
             storage2.put('accounts', {'/x': d['/x']})
             storage2.put('seed', None)
             storage2.put('seed_version', None)
@@ -233,7 +668,7 @@ class WalletStorage(PrintError):
                 xpub = mpk["x/%d'"%i]
                 new_path = storage.path + '.' + k
                 storage2 = WalletStorage(new_path)
-                storage2.data = copy.deepcopy(storage.data)
+                storage2.set_data(copy.deepcopy(storage.data))
                 # save account, derivation and xpub at index 0
                 storage2.put('accounts', {'0': x})
                 storage2.put('master_public_keys', {"x/0'": xpub})
@@ -248,20 +683,54 @@ class WalletStorage(PrintError):
     def requires_upgrade(self):
         return self.file_exists() and self.get_seed_version() < FINAL_SEED_VERSION
 
-    def upgrade(self):
+    UPGRADE_STEPS = [
+        'convert_imported',
+        'convert_wallet_type',
+        'convert_account',
+        'convert_version_13_b',
+        'convert_version_14',
+        'convert_version_15',
+        'convert_version_16',
+        'convert_version_17',
+    ]
+
+    def upgrade(self, progress_callback=None):
+        '''Run the conversion steps in a single pass, and write the file
+        once at the end.  Steps that go through large tables change them
+        in place instead of copying them.  progress_callback(fraction)
+        is called as the steps advance.'''
         self.print_error('upgrading wallet format')
-
-        self.convert_imported()
-        self.convert_wallet_type()
-        self.convert_account()
-        self.convert_version_13_b()
-        self.convert_version_14()
-        self.convert_version_15()
-        self.convert_version_16()
+        self.upgrade_callback = progress_callback
+        try:
+            for i, name in enumerate(self.UPGRADE_STEPS):
+                self.upgrade_step = i
+                self.report_upgrade_progress(0, 1)
+                getattr(self, name)()
+            self.upgrade_step = len(self.UPGRADE_STEPS)
+            self.report_upgrade_progress(0, 1)
+        finally:
+            self.upgrade_callback = None
 
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
         self.write()
 
+    def report_upgrade_progress(self, done, total):
+        if self.upgrade_callback and total:
+            steps = len(self.UPGRADE_STEPS)
+            self.upgrade_callback(min(1., (self.upgrade_step + done / total) / steps))
+
+    def get_stored(self, key):
+        '''Stored object of a top-level key, neither copied nor serialized.
+        Upgrade steps change it in place, then call touch().'''
+        with self.lock:
+            return self.data.get(key)
+
+    def touch(self, key):
+        with self.lock:
+            self.modified = True
+            self.dirty_keys.add(key)
+            self.digests.pop(key, None)
+
     def convert_wallet_type(self):
         wallet_type = self.get('wallet_type')
         if wallet_type == 'btchip': wallet_type = 'ledger'
@@ -409,42 +878,65 @@ class WalletStorage(PrintError):
         if not self._is_upgrade_method_needed(15, 15):
             return
 
-        def remove_address(addr):
-            def remove_from_dict(dict_name):
-                d = self.get(dict_name, None)
-                if d is not None:
-                    d.pop(addr, None)
-                    self.put(dict_name, d)
-
-            def remove_from_list(list_name):
-                lst = self.get(list_name, None)
-                if lst is not None:
-                    s = set(lst)
-                    s -= {addr}
-                    self.put(list_name, list(s))
-
-            # note: we don't remove 'addr' from self.get('addresses')
-            remove_from_dict('addr_history')
-            remove_from_dict('labels')
-            remove_from_dict('payment_requests')
-            remove_from_list('frozen_addresses')
+        def remove_addresses(garbage):
+            # each table is visited once, whatever the number of addresses
+            if not garbage:
+                return
+            for dict_name in ['addr_history', 'labels', 'payment_requests']:
+                d = self.get_stored(dict_name)
+                if d is not None and any(addr in d for addr in garbage):
+                    for addr in garbage:
+                        d.pop(addr, None)
+                    self.touch(dict_name)
+            lst = self.get_stored('frozen_addresses')
+            if lst is not None and garbage.intersection(lst):
+                self.put('frozen_addresses', list(set(lst) - garbage))
 
         if self.get('wallet_type') == 'imported':
-            addresses = self.get('addresses')
+            addresses = self.get_stored('addresses')
             assert isinstance(addresses, dict)
             addresses_new = dict()
+            garbage = set()
             for address, details in addresses.items():
                 if not bitcoin.is_address(address):
-                    remove_address(address)
+                    garbage.add(address)
                     continue
                 if details is None:
                     addresses_new[address] = {}
                 else:
                     addresses_new[address] = details
+            # note: we don't remove garbage from the 'addresses' key
+            remove_addresses(garbage)
             self.put('addresses', addresses_new)
 
         self.put('seed_version', 16)
 
+    def convert_version_17(self):
+        # txo entries record the output type: (n, value, is_coinbase, type)
+        if not self._is_upgrade_method_needed(16, 16):
+            return
+
+        from .transaction import Transaction
+        txo = self.get_stored('txo') or {}
+        transactions = self.get_stored('transactions') or {}
+        for i, (tx_hash, d) in enumerate(txo.items()):
+            if i % 1000 == 0:
+                self.report_upgrade_progress(i, len(txo))
+            if all(len(item) == 4 for l in d.values() for item in l):
+                continue
+            raw = transactions.get(tx_hash)
+            outputs = Transaction(raw).outputs() if raw else []
+            for addr, l in d.items():
+                for item in l:
+                    if len(item) != 3:
+                        continue
+                    n = item[0]
+                    _type = outputs[n][0] if n < len(outputs) else bitcoin.TYPE_ADDRESS
+                    item.append(_type)
+            self.touch('txo')
+
+        self.put('seed_version', 17)
+
     def convert_imported(self):
         # '/x' is the internal ID for imported accounts
         d = self.get('accounts', {}).get('/x', {}).get('imported',{})
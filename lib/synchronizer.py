@@ -24,12 +24,53 @@
 # SOFTWARE.
 from threading import Lock
 import hashlib
+import heapq
+import itertools
 
 # from .bitcoin import Hash, hash_encode
 from .transaction import Transaction
 from .util import ThreadJob, bh2u
 
 
+# request kinds, in the order they are sent when equally urgent
+HISTORY, SUBSCRIBE, TX = range(3)
+
+
+class SyncScheduler(object):
+    '''Queue of pending synchronizer requests.  Items with the lowest
+    priority are sent first, and no more than `budget` requests are in
+    flight at any time.'''
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.queue = []
+        self.counter = itertools.count()
+        self.in_flight = set()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, kind, key, priority):
+        heapq.heappush(self.queue, ((kind,) + priority, next(self.counter), kind, key))
+
+    def done(self, kind, key):
+        self.in_flight.discard((kind, key))
+
+    def pop_ready(self):
+        '''Returns the (kind, key) items that may be sent now.'''
+        items = []
+        while self.queue and len(self.in_flight) < self.budget:
+            kind, key = heapq.heappop(self.queue)[2:]
+            self.in_flight.add((kind, key))
+            items.append((kind, key))
+        return items
+
+
+def height_priority(height):
+    # unconfirmed first, then most recent blocks
+    return (0,) if height <= 0 else (1, -height)
+
+
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -50,6 +91,8 @@ class Synchronizer(ThreadJob):
         self.requested_histories = {}
         self.requested_addrs = set()
         self.lock = Lock()
+        budget = network.config.get('sync_concurrency', 100)
+        self.scheduler = SyncScheduler(budget)
         self.initialize()
 
     def parse_response(self, response):
@@ -70,10 +113,39 @@ class Synchronizer(ThreadJob):
         with self.lock:
             self.new_addresses.add(address)
 
+    def address_priority(self, addr):
+        # receiving addresses first, then by their latest activity
+        heights = [h for tx_hash, h in self.wallet.get_address_history(addr)]
+        if not heights:
+            recency = (2,)
+        else:
+            recency = height_priority(min(heights) if min(heights) <= 0 else max(heights))
+        return (int(self.wallet.is_change(addr)),) + recency
+
     def subscribe_to_addresses(self, addresses):
-        if addresses:
-            self.requested_addrs |= addresses
-            self.network.subscribe_to_addresses(addresses, self.on_address_status)
+        for addr in addresses:
+            if addr not in self.requested_addrs:
+                self.requested_addrs.add(addr)
+                self.scheduler.put(SUBSCRIBE, addr, self.address_priority(addr))
+
+    def send_requests(self):
+        subscriptions, txs = [], []
+        for kind, key in self.scheduler.pop_ready():
+            if kind == HISTORY:
+                self.network.request_address_history(key, self.on_address_history)
+            elif kind == SUBSCRIBE:
+                subscriptions.append(key)
+            else:
+                txs.append(('blockchain.transaction.get', [key]))
+        if subscriptions:
+            self.network.subscribe_to_addresses(subscriptions, self.on_address_status)
+        if txs:
+            self.network.send(txs, self.tx_response)
+
+    def request_done(self, kind, response):
+        params = response.get('params')
+        if params:
+            self.scheduler.done(kind, params[0])
 
     def get_status(self, h):
         if not h:
@@ -84,6 +156,7 @@ class Synchronizer(ThreadJob):
         return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
     def on_address_status(self, response):
+        self.request_done(SUBSCRIBE, response)
         params, result = self.parse_response(response)
         if not params:
             return
@@ -92,12 +165,14 @@ class Synchronizer(ThreadJob):
         if self.get_status(history) != result:
             if self.requested_histories.get(addr) is None:
                 self.requested_histories[addr] = result
-                self.network.request_address_history(addr, self.on_address_history)
+                self.scheduler.put(HISTORY, addr, self.address_priority(addr))
         # remove addr from list only after it is added to requested_histories
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
+        self.send_requests()
 
     def on_address_history(self, response):
+        self.request_done(HISTORY, response)
         params, result = self.parse_response(response)
         if not params:
             return
@@ -135,8 +210,11 @@ class Synchronizer(ThreadJob):
             self.request_missing_txs(hist)
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
+        self.send_requests()
 
     def tx_response(self, response):
+        self.request_done(TX, response)
+        self.send_requests()
         params, result = self.parse_response(response)
         if not params:
             return
@@ -144,7 +222,7 @@ class Synchronizer(ThreadJob):
         #assert tx_hash == hash_encode(Hash(bytes.fromhex(result)))
         tx = Transaction(result)
         try:
-            tx.deserialize()
+            tx.deserialize(scripts=False)
         except Exception:
             self.print_msg("cannot deserialize transaction, skipping", tx_hash)
             return
@@ -160,15 +238,13 @@ class Synchronizer(ThreadJob):
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
-        requests = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            requests.append(('blockchain.transaction.get', [tx_hash]))
+            self.scheduler.put(TX, tx_hash, height_priority(tx_height))
             self.requested_tx[tx_hash] = tx_height
-        self.network.send(requests, self.tx_response)
 
 
     def initialize(self):
@@ -198,6 +274,7 @@ class Synchronizer(ThreadJob):
             addresses = self.new_addresses
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
+        self.send_requests()
 
         # 3. Detect if situation has changed
         up_to_date = self.is_up_to_date()
@@ -53,6 +53,63 @@ class Test_bitcoin(unittest.TestCase):
         #print signature
         EC_KEY.verify_message(eck, signature, message)
 
+    def test_ecdh_matches_python_ecdsa(self):
+        from unittest import mock
+        import lib.bitcoin as bitcoin
+        _r = generator_secp256k1.order()
+        secret = 2**300 + 12345
+        other = point_to_ser(generator_secp256k1 * 7)
+        expected_point = generator_secp256k1 * (secret % _r)
+        expected_ecdh = point_to_ser(bitcoin.ser_to_point(other) * secret)
+        for backend in [bitcoin.coincurve, None]:
+            with mock.patch.object(bitcoin, 'coincurve', backend):
+                self.assertEqual(expected_point, bitcoin.public_point(secret))
+                self.assertEqual(expected_ecdh, bitcoin.ecdh(other, secret))
+                with self.assertRaises(ValueError):
+                    bitcoin.ecdh(b'\x04' + b'\x01' * 64, secret)
+        eck = EC_KEY(number_to_string(secret % _r, _r))
+        enc = EC_KEY.encrypt_message(b'message', bfh(eck.get_public_key()))
+        with mock.patch.object(bitcoin, 'coincurve', None):
+            self.assertEqual(b'message', eck.decrypt_message(enc))
+
+    def test_ecc_backends_match(self):
+        from unittest import mock
+        import lib.bitcoin as bitcoin
+        _r = generator_secp256k1.order()
+        # known RFC 6979 vector, with a low S value
+        h = bitcoin.sha256(b'Satoshi Nakamoto')
+        expected = ('934b1ea10a4b3c1757e2b0c017d0b6143ce3c9a7e6a4a49860d7a6ab210ee3d8'
+                    '2442ce9d2b916064108014783e923ec36b49743e2ffa1c4496f01a512aafd9e5')
+        secrets = [1, 2**255 + 12345, _r - 1]
+        hashes = [h, Hash(b'Electrum'), b'\xff' * 32]
+        results = []
+        for backend in [bitcoin.coincurve, None]:
+            with mock.patch.object(bitcoin, 'coincurve', backend):
+                sig, recid = bitcoin.ecdsa_sign_recoverable(1, h)
+                self.assertEqual(expected, bitcoin.bh2u(sig))
+                r = []
+                for secret in secrets:
+                    pubkey = point_to_ser(generator_secp256k1 * secret)
+                    for msg_hash in hashes:
+                        der = bitcoin.ecdsa_sign(secret, msg_hash)
+                        sig, recid = bitcoin.ecdsa_sign_recoverable(secret, msg_hash)
+                        self.assertEqual(der, bitcoin.compact_to_der(sig))
+                        self.assertEqual(pubkey, bitcoin.ecdsa_recover(sig, recid, msg_hash, True))
+                        self.assertTrue(bitcoin.ecdsa_verify(pubkey, der, msg_hash))
+                        self.assertFalse(bitcoin.ecdsa_verify(pubkey, der, Hash(msg_hash)))
+                        # high S values are accepted too
+                        r_, s_ = ecdsa.util.sigdecode_string(sig, _r)
+                        self.assertTrue(bitcoin.ecdsa_verify(pubkey, ecdsa.util.sigencode_der(r_, _r - s_, _r), msg_hash))
+                        r.append((der, sig, recid))
+                    r.append(bitcoin.tweak_public_key(pubkey, number_to_string(secret, _r), False))
+                xprv, xpub = bip32_root(bytes(range(32)), 'standard')
+                r.append(bip32_public_derivation(xpub, 'm/', 'm/0/1/2'))
+                r.append(bip32_private_derivation(xprv, 'm/', "m/0'/1")[1])
+                eck = EC_KEY(number_to_string(secrets[1], _r))
+                r.append(eck.sign_message(b'Electrum', True))
+                results.append(r)
+        self.assertEqual(results[0], results[1])
+
     def test_msg_signing(self):
         msg1 = b'Chancellor on brink of second bailout for banks'
         msg2 = b'Electrum'
@@ -0,0 +1,18 @@
+import unittest
+
+from lib.commands import get_parser, get_verbosity
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def verbosity(self, *args):
+        return get_verbosity(get_parser().parse_args(list(args)).__dict__)
+
+    def test_verbosity(self):
+        self.assertEqual(0, self.verbosity('daemon'))
+        self.assertEqual(1, self.verbosity('-v', 'daemon'))
+        self.assertEqual(2, self.verbosity('-vv', 'daemon'))
+        self.assertEqual(2, self.verbosity('daemon', '-vv'))
+        self.assertEqual(2, self.verbosity('gui', '-g', 'qt', '-vv'))
+        self.assertEqual(0, self.verbosity('gui', '-g', 'kivy', '-vv'))
+        self.assertEqual(1, get_verbosity({'verbose': True}))
@@ -0,0 +1,71 @@
+import unittest
+
+from lib.synchronizer import Synchronizer, SyncScheduler, HISTORY, SUBSCRIBE, TX
+
+
+class FakeNetwork(object):
+
+    def __init__(self, budget):
+        self.config = {'sync_concurrency': budget}
+        self.subscribed = []
+        self.sent = []
+
+    def subscribe_to_addresses(self, addresses, callback):
+        self.subscribed.extend(addresses)
+
+    def request_address_history(self, addr, callback):
+        pass
+
+    def send(self, messages, callback):
+        self.sent.extend(params[0] for method, params in messages)
+
+
+class FakeWallet(object):
+
+    def __init__(self, history, change):
+        self.history = history
+        self.change = change
+        self.transactions = {}
+
+    def get_addresses(self):
+        return list(self.history.keys())
+
+    def get_address_history(self, addr):
+        return self.history.get(addr, [])
+
+    def is_change(self, addr):
+        return addr in self.change
+
+
+class TestSyncScheduler(unittest.TestCase):
+
+    def test_budget_and_order(self):
+        s = SyncScheduler(2)
+        s.put(TX, 'old', (1, -10))
+        s.put(TX, 'new', (1, -20))
+        s.put(SUBSCRIBE, 'addr', (0, 2))
+        s.put(HISTORY, 'hist', (1, 2))
+        self.assertEqual([(HISTORY, 'hist'), (SUBSCRIBE, 'addr')], s.pop_ready())
+        self.assertEqual([], s.pop_ready())
+        s.done(SUBSCRIBE, 'addr')
+        self.assertEqual([(TX, 'new')], s.pop_ready())
+        self.assertEqual(1, len(s))
+
+
+class TestSynchronizer(unittest.TestCase):
+
+    def test_recent_receiving_first(self):
+        history = {
+            'change_recent': [('c', 300)],
+            'recv_old': [('a', 100)],
+            'recv_recent': [('a', 100), ('b', 200)],
+            'recv_mempool': [('d', 0)],
+            'recv_unused': [],
+        }
+        network = FakeNetwork(budget=100)
+        sync = Synchronizer(FakeWallet(history, {'change_recent'}), network)
+        sync.send_requests()
+        self.assertEqual(['recv_mempool', 'recv_recent', 'recv_old', 'recv_unused', 'change_recent'],
+                         network.subscribed)
+        self.assertEqual(['d', 'c', 'b', 'a'], network.sent)
+        self.assertFalse(sync.is_up_to_date())
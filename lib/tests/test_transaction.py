@@ -1,10 +1,11 @@
 import unittest
-from lib import transaction
-from lib.bitcoin import TYPE_ADDRESS
+from unittest import mock
+from lib import bitcoin, transaction
+from lib.bitcoin import TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT
 
 from lib.keystore import xpubkey_to_address
 
-from lib.util import bh2u
+from lib.util import bh2u, bfh
 
 unsigned_blob = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000005701ff4c53ff0488b21e03ef2afea18000000089689bff23e1e7fb2f161daa37270a97a3d8c2e537584b2d304ecb47b86d21fc021b010d3bd425f8cf2e04824bfdf1f1f5ff1d51fadd9a41f9e3fb8dd3403b1bfe00000000ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
 signed_blob = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
@@ -26,6 +27,7 @@ class TestBCDataStream(unittest.TestCase):
                           '0001fcfdfd00fdfffffe00000100feffffffffff0000000001000000ffffffffffffffffff')
         for v in values:
             self.assertEqual(s.read_compact_size(), v)
+        self.assertEqual(b''.join(transaction.compact_size(v) for v in values), bytes(s.input))
 
         with self.assertRaises(transaction.SerializationError):
             s.read_compact_size()
@@ -52,6 +54,18 @@ class TestBCDataStream(unittest.TestCase):
         self.assertEqual(s.read_bytes(4), b'r')
         self.assertEqual(s.read_bytes(1), b'')
 
+    def test_read_from(self):
+        data = bytearray(b'\x06foobar\x01\x00\x00\x00')
+        s = transaction.BCDataStream()
+        s.read_from(data)
+        self.assertEqual(s.read_string(), 'foobar')
+        self.assertEqual(s.read_uint32(), 1)
+        s.read_cursor = 1
+        view = s.read_bytes(3)
+        self.assertIsInstance(view, memoryview)
+        data[1:4] = b'FOO'
+        self.assertEqual(bytes(view), b'FOO')
+
 class TestTransaction(unittest.TestCase):
 
     def test_tx_unsigned(self):
@@ -145,6 +159,189 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(tx.estimated_weight(), 561)
         self.assertEqual(tx.estimated_size(), 141)
 
+    def _make_multi_input_tx(self, keypairs):
+        inputs = []
+        for i in range(12):
+            sec = bitcoin.sha256(bytes([i]))
+            pubkey = bitcoin.public_key_from_private_key(sec, True)
+            txin_type = 'p2wpkh' if i % 3 == 0 else 'p2pkh'
+            keypairs[pubkey] = sec, True
+            inputs.append({
+                'type': txin_type,
+                'address': bitcoin.pubkey_to_address(txin_type, pubkey),
+                'prevout_hash': '%064x' % (i + 1),
+                'prevout_n': i,
+                'value': 100000 + i,
+                'pubkeys': [pubkey],
+                'x_pubkeys': [pubkey],
+                'signatures': [None],
+                'num_sig': 1,
+            })
+        outputs = [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000000)]
+        return transaction.Transaction.from_io(inputs, outputs)
+
+    def test_sign_in_process_pool(self):
+        keypairs = {}
+        tx1 = self._make_multi_input_tx(keypairs)
+        preimages = [tx1.serialize_preimage(i) for i in range(12)]
+        parts = tx1.get_preimage_parts()
+        self.assertEqual(preimages, [tx1.serialize_preimage(i, parts) for i in range(12)])
+        tx1.sign(keypairs)
+        self.assertTrue(tx1.is_complete())
+        tx2 = self._make_multi_input_tx({})
+        tx2.sign(keypairs, processes=2)
+        self.assertEqual(tx1.raw, tx2.raw)
+        # signing again does not change anything
+        tx2.sign(keypairs, processes=2)
+        self.assertEqual(tx1.raw, tx2.raw)
+
+    def test_output_script_templates(self):
+        pubkey = bitcoin.public_key_from_private_key(bitcoin.sha256(b'\x01'), True)
+        h160 = bh2u(bitcoin.hash_160(bitcoin.bfh(pubkey)))
+        governance = '6a' + bitcoin.push_script(bh2u(b'LBTC')) + bitcoin.push_script(pubkey) + bitcoin.push_script('c1' + h160)
+        cases = [
+            ('76a914' + h160 + '88ac', (TYPE_ADDRESS, bitcoin.hash160_to_p2pkh(bitcoin.bfh(h160)))),
+            # the same with a PUSHDATA1 push, matched by the generic decoder
+            ('76a94c14' + h160 + '88ac', (TYPE_ADDRESS, bitcoin.hash160_to_p2pkh(bitcoin.bfh(h160)))),
+            ('a914' + h160 + '87', (TYPE_ADDRESS, bitcoin.hash160_to_p2sh(bitcoin.bfh(h160)))),
+            ('0014' + h160, (TYPE_ADDRESS, bitcoin.hash_to_segwit_addr(bitcoin.bfh(h160)))),
+            ('0020' + '11' * 32, (TYPE_ADDRESS, bitcoin.hash_to_segwit_addr(b'\x11' * 32))),
+            ('21' + pubkey + 'ac', (TYPE_PUBKEY, pubkey)),
+            (governance, (TYPE_SCRIPT, governance)),
+            ('51', (TYPE_SCRIPT, '51')),
+        ]
+        for script, expected in cases:
+            self.assertEqual(expected, transaction.get_address_from_output_script(bitcoin.bfh(script)))
+
+    def test_size_model(self):
+        pubkeys = [bitcoin.public_key_from_private_key(bitcoin.sha256(bytes([i])), i != 2) for i in range(3)]
+        inputs = []
+        for txin_type in ['p2pkh', 'p2pk', 'p2wpkh', 'p2wpkh-p2sh', 'p2sh', 'p2wsh', 'p2wsh-p2sh']:
+            multisig = txin_type in ['p2sh', 'p2wsh', 'p2wsh-p2sh']
+            for keys in ([pubkeys[:2], pubkeys[1:], pubkeys] if multisig else [pubkeys[:1], pubkeys[2:]]):
+                inputs.append({
+                    'type': txin_type,
+                    'prevout_hash': '%064x' % len(inputs),
+                    'prevout_n': 1,
+                    'value': 100000,
+                    'pubkeys': list(keys),
+                    'x_pubkeys': list(keys),
+                    'signatures': [None] * len(keys),
+                    'num_sig': 2 if multisig else 1,
+                })
+        inputs.append({'type': 'coinbase', 'scriptSig': '03400d03', 'prevout_hash': '00' * 32, 'prevout_n': 0xffffffff})
+        T = transaction.Transaction
+        for txin in inputs:
+            script = bitcoin.bfh(T.input_script(txin, True))
+            self.assertEqual(len(T.serialize_input_bytes(txin, script)), T.estimated_input_size(txin))
+            self.assertEqual(len(T.serialize_witness_bytes(txin, True)), T.estimated_input_witness_size(txin))
+        outputs = [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000000)]
+        for tx_inputs in [inputs, inputs[:2], inputs[2:3]]:
+            tx = T.from_io(tx_inputs, outputs)
+            self.assertEqual(len(tx.serialize_bytes(True)), tx.estimated_total_size())
+            witness_size = len(tx.serialize_bytes(True)) - len(tx.serialize_bytes(True, witness=False))
+            self.assertEqual(witness_size, tx.estimated_witness_size())
+
+    def test_preimage_hashes(self):
+        tx = self._make_multi_input_tx({})
+        expected = dict((i, bitcoin.Hash(tx.serialize_preimage_bytes(i))) for i in range(12))
+        self.assertEqual(expected, tx.get_preimage_hashes(range(12)))
+        self.assertEqual({1: expected[1], 8: expected[8], 9: expected[9]}, tx.get_preimage_hashes([9, 1, 8, 9]))
+
+    def test_cached_txid_and_size(self):
+        keypairs = {}
+        tx = self._make_multi_input_tx(keypairs)
+        self.assertIsNone(tx.txid())
+        self.assertEqual(tx.estimated_size(), tx.estimated_size())
+        tx.sign(keypairs)
+        txid = tx.txid()
+        self.assertIsNotNone(txid)
+        self.assertEqual(transaction.Transaction(tx.raw).estimated_size(), tx.estimated_size())
+        tx.locktime = 1
+        self.assertNotEqual(txid, tx.txid())
+        tx.locktime = 0
+        self.assertEqual(txid, tx.txid())
+        tx.set_rbf(True)
+        self.assertNotEqual(txid, tx.txid())
+        self.assertEqual(tx.serialize(), transaction.Transaction(tx.serialize()).serialize())
+
+    def test_deserialize_without_scripts(self):
+        for blob in [signed_blob, v2_blob, signed_segwit_blob]:
+            d = transaction.deserialize(blob)
+            d2 = transaction.deserialize(blob, scripts=False)
+            scripts = [o.pop('scriptPubKey') for o in d['outputs']]
+            self.assertEqual(d, d2)
+            # made when looked up
+            self.assertEqual(scripts, [o['scriptPubKey'] for o in d2['outputs']])
+            self.assertEqual(scripts[0], d2['outputs'][0].get('scriptPubKey'))
+
+    def test_serialize_bytes(self):
+        for blob in [unsigned_blob, signed_blob, v2_blob, signed_segwit_blob]:
+            tx = transaction.Transaction(blob)
+            self.assertEqual(bh2u(tx.serialize_bytes()), blob)
+            self.assertEqual(tx.serialize(), blob)
+        tx = self._make_multi_input_tx({})
+        for i in range(12):
+            self.assertEqual(bh2u(tx.serialize_preimage_bytes(i)), tx.serialize_preimage(i))
+        self.assertTrue(tx.serialize_preimage(1).endswith(bitcoin.int_to_hex(0x4354424c, 4)))
+
+    def test_partial_transaction(self):
+        keys = ['prevout_hash', 'prevout_n', 'sequence', 'type', 'address', 'num_sig', 'pubkeys', 'x_pubkeys', 'signatures']
+        for blob in [unsigned_blob, signed_blob, v2_blob, signed_segwit_blob]:
+            tx = transaction.Transaction(blob)
+            partial = tx.serialize_partial()
+            self.assertTrue(partial.startswith(transaction.PARTIAL_TX_PREFIX))
+            tx2 = transaction.Transaction(partial)
+            self.assertEqual(blob, tx2.serialize())
+            self.assertEqual(blob, transaction.Transaction.from_partial(bfh(partial)).serialize())
+            for txin, txin2 in zip(tx.inputs(), tx2.inputs()):
+                self.assertEqual([txin.get(k) for k in keys], [txin2.get(k) for k in keys])
+            self.assertEqual(tx.outputs(), tx2.outputs())
+        # the extended pubkeys are not parsed again
+        partial = transaction.Transaction(unsigned_blob).serialize_partial()
+        with mock.patch.object(transaction, 'xpubkey_to_pubkey', side_effect=AssertionError), \
+             mock.patch.object(transaction, 'xpubkey_to_address', side_effect=AssertionError):
+            tx = transaction.Transaction(partial)
+            self.assertEqual(unsigned_blob, tx.serialize())
+        tx.update_signatures(signed_blob)
+        self.assertEqual(signed_blob, tx.raw)
+        # values of segwit inputs are kept, for signing, and those of
+        # legacy inputs only come from the tx they spend
+        keypairs = {}
+        tx = self._make_multi_input_tx(keypairs)
+        tx2 = transaction.Transaction(tx.serialize_partial())
+        self.assertEqual([txin['value'] if tx.is_segwit_input(txin) else None for txin in tx.inputs()],
+                         [txin.get('value') for txin in tx2.inputs()])
+        tx.sign(keypairs)
+        tx2.sign(keypairs)
+        self.assertEqual(tx.raw, tx2.raw)
+        prev_tx = transaction.Transaction(v2_blob)
+        tx = self._make_multi_input_tx({})
+        txin = tx.inputs()[1]
+        txin.update({'prevout_hash': prev_tx.txid(), 'prevout_n': 1, 'value': 1, 'prev_tx': prev_tx})
+        self.assertEqual(100000, transaction.Transaction(tx.serialize_partial()).inputs()[1]['value'])
+        txin['prevout_n'] = 2
+        with self.assertRaises(transaction.SerializationError):
+            transaction.Transaction(tx.serialize_partial()).inputs()
+        txin['prev_tx'] = transaction.Transaction(signed_blob)
+        with self.assertRaises(transaction.SerializationError):
+            transaction.Transaction(tx.serialize_partial()).inputs()
+        # complete 2 of 3 multisig, signatures not in the slots of their pubkeys
+        secs = [bitcoin.sha256(bytes([i])) for i in range(3)]
+        pubkeys = sorted(bitcoin.public_key_from_private_key(sec, True) for sec in secs)
+        keypairs = dict((bitcoin.public_key_from_private_key(sec, True), (sec, True)) for sec in secs[:2])
+        txin = {'type': 'p2sh', 'prevout_hash': '%064x' % 1, 'prevout_n': 0, 'value': 100000,
+                'pubkeys': pubkeys, 'x_pubkeys': list(pubkeys), 'signatures': [None] * 3, 'num_sig': 2,
+                'address': bitcoin.hash160_to_p2sh(bitcoin.hash_160(bfh(transaction.multisig_script(pubkeys, 2))))}
+        tx = transaction.Transaction.from_io([txin], [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 90000)])
+        tx.sign(keypairs)
+        tx2 = transaction.Transaction(transaction.Transaction(tx.raw).serialize_partial())
+        self.assertEqual(tx.raw, tx2.serialize())
+        with self.assertRaises(transaction.SerializationError):
+            transaction.Transaction.from_partial(b'ptx\x00')
+        with self.assertRaises(transaction.SerializationError):
+            transaction.Transaction.from_partial(bfh(partial)[:-20])
+
     def test_errors(self):
         with self.assertRaises(TypeError):
             transaction.Transaction.pay_script(output_type=None, addr='')
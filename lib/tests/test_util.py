@@ -1,5 +1,9 @@
+import io
 import unittest
-from lib.util import format_satoshis, parse_URI
+from contextlib import redirect_stderr
+
+from lib import util
+from lib.util import format_satoshis, parse_URI, PrintError, LazyStr
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +72,24 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+    def test_verbosity_levels(self):
+        calls = []
+        def describe():
+            calls.append(1)
+            return 'details'
+        obj = PrintError()
+        level = util.verbosity
+        try:
+            for verbosity in range(3):
+                util.set_verbosity(verbosity)
+                out = io.StringIO()
+                with redirect_stderr(out):
+                    obj.print_error('error', LazyStr(describe))
+                    obj.print_debug('debug', LazyStr(describe))
+                lines = out.getvalue().splitlines()
+                self.assertEqual(verbosity, len(lines))
+                self.assertEqual(verbosity, len(calls))
+                del calls[:]
+            self.assertEqual('[PrintError] debug details', lines[1])
+        finally:
+            util.set_verbosity(level)
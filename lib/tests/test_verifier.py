@@ -0,0 +1,99 @@
+import unittest
+
+from lib.bitcoin import Hash, hash_decode, hash_encode
+from lib.verifier import SPV
+
+
+def merkle_root(tx_hashes):
+    level = [hash_decode(h) for h in tx_hashes]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [Hash(level[i] + level[i+1]) for i in range(0, len(level), 2)]
+    return hash_encode(level[0])
+
+
+class FakeBlockchain(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.reads = 0
+
+    def read_header(self, height):
+        self.reads += 1
+        return self.headers.get(height)
+
+    def get_checkpoint(self):
+        return 0
+
+
+class FakeNetwork(object):
+
+    def __init__(self, blockchain):
+        self._blockchain = blockchain
+        self.sends = []
+
+    def blockchain(self):
+        return self._blockchain
+
+    def get_local_height(self):
+        return 1000
+
+    def send(self, messages, callback):
+        self.sends.append(list(messages))
+
+
+class FakeWallet(object):
+
+    def __init__(self, unverified):
+        self.unverified = unverified
+        self.verified = {}
+
+    def get_unverified_txs(self):
+        return self.unverified
+
+    def add_verified_tx(self, tx_hash, info):
+        self.verified[tx_hash] = info
+
+
+class TestSPV(unittest.TestCase):
+
+    def setUp(self):
+        # two txs in block 100, one in block 200
+        self.txs_100 = ['%064x' % 1, '%064x' % 2]
+        self.txs_200 = ['%064x' % 3, '%064x' % 4]
+        headers = {
+            100: {'merkle_root': merkle_root(self.txs_100), 'timestamp': 1},
+            200: {'merkle_root': merkle_root(self.txs_200), 'timestamp': 2},
+        }
+        self.blockchain = FakeBlockchain(headers)
+        self.network = FakeNetwork(self.blockchain)
+        unverified = {self.txs_200[0]: 200, self.txs_100[0]: 100,
+                      self.txs_100[1]: 100, '%064x' % 5: 2000}
+        self.wallet = FakeWallet(unverified)
+        self.spv = SPV(self.network, self.wallet)
+
+    def response(self, tx_hash, height, branch, pos):
+        return {'params': [tx_hash, height],
+                'result': {'block_height': height, 'pos': pos, 'merkle': branch}}
+
+    def test_requests_are_batched_by_height(self):
+        self.spv.run()
+        self.assertEqual(1, len(self.network.sends))
+        heights = [params[1] for method, params in self.network.sends[0]]
+        self.assertEqual([100, 100, 200], heights)
+        self.spv.run()
+        self.assertEqual(1, len(self.network.sends))
+
+    def test_header_read_once_per_block(self):
+        a, b = self.txs_100
+        self.spv.verify_merkle(self.response(a, 100, [b], 0))
+        self.spv.verify_merkle(self.response(b, 100, [a], 1))
+        self.assertEqual(1, self.blockchain.reads)
+        self.assertEqual({a: (100, 1, 0), b: (100, 1, 1)}, self.wallet.verified)
+
+    def test_bad_branch_not_verified(self):
+        a, b = self.txs_100
+        self.spv.verify_merkle(self.response(a, 100, [b], 0))
+        self.spv.verify_merkle(self.response(b, 100, [b], 1))
+        self.assertNotIn(b, self.wallet.verified)
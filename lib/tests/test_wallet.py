@@ -67,3 +67,314 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_write_matches_json_dumps(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("txi", {"ab": {"addr": [["cd:0", 5]]}, "ef": {}})
+        storage.put("labels", {})
+        storage.put("use_change", True)
+        storage.write()
+        storage.put("labels", {"x": "y\nz"})
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertEqual(json.dumps(storage.data, indent=4, sort_keys=True), contents)
+
+    def test_shared_values(self):
+        storage = WalletStorage(self.wallet_path)
+        history = {"addr": [["ab", 1]]}
+        storage.put("addr_history", history, shared=True)
+        self.assertIs(history, storage.get("addr_history", shared=True))
+        self.assertIsNot(history, storage.get("addr_history"))
+        storage.write()
+        # only marked as changed when put again
+        history["addr"].append(["cd", 2])
+        self.assertFalse(storage.modified)
+        storage.put("addr_history", history, shared=True)
+        self.assertEqual({"addr_history"}, storage.dirty_keys)
+        storage.write()
+        self.assertEqual(history, WalletStorage(self.wallet_path).get("addr_history"))
+        storage.put("addr_history", history, shared=True)
+        self.assertFalse(storage.modified)
+
+    def test_replace_is_not_a_change(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("txo", {"ab": {"addr": [[0, 1, False]]}})
+        storage.write()
+        txo = {"ab": {"addr": [(0, 1, False)]}}
+        storage.replace("txo", txo)
+        self.assertFalse(storage.modified)
+        self.assertIs(txo, storage.get("txo", shared=True))
+        storage.put("txo", txo, shared=True)
+        self.assertFalse(storage.modified)
+
+    def test_autosave(self):
+        storage = WalletStorage(self.wallet_path)
+        saved = []
+        storage.set_autosave(0.05, lambda: saved.append(True))
+        storage.put("a", "b")
+        timer = storage.autosave_timer
+        storage.put("c", "d")
+        self.assertFalse(timer.daemon)
+        timer.join()
+        self.assertEqual([True], saved)
+        self.assertFalse(storage.modified)
+        self.assertEqual("d", WalletStorage(self.wallet_path).get("c"))
+        stats = storage.get_write_stats()
+        self.assertEqual(1, stats['writes'])
+        self.assertEqual(os.path.getsize(self.wallet_path), stats['bytes'])
+
+        storage.set_autosave(0)
+        storage.put("a", "c")
+        self.assertIsNone(storage.autosave_timer)
+
+        storage.set_autosave(10)
+        storage.put("a", "d")
+        timer = storage.autosave_timer
+        storage.set_autosave(0)
+        self.assertFalse(timer.is_alive())
+
+    def test_shared_values_are_taken_under_shared_locks(self):
+        events = []
+
+        class Lock:
+            def acquire(self):
+                events.append('acquire')
+
+            def release(self):
+                events.append('release')
+
+        storage = WalletStorage(self.wallet_path)
+        storage.set_shared_locks([Lock(), Lock()])
+        chunk_texts = storage.chunk_texts
+        storage.chunk_texts = lambda value: events.append('snapshot') or chunk_texts(value)
+        txo = {"ab": {"addr": [[0, 1, False]]}}
+        storage.put("txo", txo, shared=True)
+        storage.put("labels", {})
+        storage.write()
+        self.assertEqual(['acquire', 'acquire', 'snapshot', 'release', 'release'], events)
+        self.assertEqual(txo, WalletStorage(self.wallet_path).get("txo"))
+
+    def test_encrypted_stream(self):
+        from unittest import mock
+        from lib import storage as storage_module
+        from lib.util import InvalidPassword
+        storage = WalletStorage(self.wallet_path)
+        txs = dict(('%064x' % i, '00' * i) for i in range(300))
+        storage.put("transactions", txs)
+        storage.put("labels", {"a": "b"})
+        storage.set_password("secret", True)
+        storage.set_stream_encryption(True)
+        with mock.patch.object(storage_module, 'STREAM_CHUNK_SIZE', 1024), \
+             mock.patch.object(storage_module, 'STREAM_LINE_ITEMS', 7):
+            storage.write()
+
+        with open(self.wallet_path, "rb") as f:
+            raw = f.read()
+        self.assertTrue(raw.startswith(b'BIE2'))
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted())
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt("wrong")
+        storage.decrypt("secret")
+        self.assertEqual(txs, storage.get("transactions"))
+        self.assertEqual({"a": "b"}, storage.get("labels"))
+        # the format is kept
+        storage.put("labels", {"a": "c"})
+        storage.write()
+        with open(self.wallet_path, "rb") as f:
+            self.assertTrue(f.read().startswith(b'BIE2'))
+
+        with open(self.wallet_path, "wb") as f:
+            f.write(raw[:len(raw) // 2])
+        with self.assertRaises(IOError):
+            WalletStorage(self.wallet_path).decrypt("secret")
+
+    def test_encrypted_default_format(self):
+        import base64
+        storage = WalletStorage(self.wallet_path)
+        storage.put("labels", {"a": "b"})
+        storage.set_password("secret", True)
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(b'BIE1', base64.b64decode(f.read())[0:4])
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt("secret")
+        self.assertEqual({"a": "b"}, storage.get("labels"))
+
+    def test_read_bie1_file(self):
+        from lib import bitcoin
+        import zlib
+        storage = WalletStorage(self.wallet_path)
+        pubkey = storage.get_key("secret").get_public_key()
+        contents = json.dumps({"a": "b", "seed_version": FINAL_SEED_VERSION})
+        with open(self.wallet_path, "w") as f:
+            f.write(bitcoin.encrypt_message(zlib.compress(contents.encode('utf8')), pubkey).decode('utf8'))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted())
+        storage.decrypt("secret")
+        self.assertEqual("b", storage.get("a"))
+        storage.put("a", "c")
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt("secret")
+        self.assertEqual("c", storage.get("a"))
+
+    def test_key_cache(self):
+        from lib.util import InvalidPassword
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password("secret", True)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt("wrong")
+        self.assertIsNone(storage.key_cache)
+        storage.decrypt("secret")
+        ec_key = storage.key_cache[1]
+        self.assertIs(ec_key, storage.get_key("secret"))
+        self.assertIsNot(ec_key, storage.get_key("wrong"))
+        self.assertIsNone(WalletStorage(self.wallet_path).key_cache)
+        storage.set_password("other", True)
+        self.assertIsNone(storage.key_cache)
+
+    def test_log_format_appends_changed_keys(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", {"x": 1})
+        storage.put("b", [1, 2])
+        storage.write()
+        storage.set_log_format(True)
+        storage.write()
+        storage.put("a", {"x": 2})
+        storage.put("b", None)
+        storage.write()
+
+        with open(self.wallet_path, "r") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual({"a": {"x": 2}, "b": None}, json.loads(lines[2]))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"x": 2}, storage.get("a"))
+        self.assertEqual(None, storage.get("b"))
+        self.assertEqual(FINAL_SEED_VERSION, storage.get("seed_version"))
+
+    def test_log_format_ignores_truncated_record(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_log_format(True)
+        storage.put("a", "b")
+        storage.write()
+        with open(self.wallet_path, "a") as f:
+            f.write('{"a": "c"')
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("b", storage.get("a"))
+
+    def test_log_format_writes_after_truncated_record(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_log_format(True)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("b", 1)
+        storage.write()
+        with open(self.wallet_path, "a") as f:
+            f.write('{"c": 3')
+
+        storage = WalletStorage(self.wallet_path)
+        storage.put("d", 4)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(4, storage.get("d"))
+        storage.put("e", 5)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(("b", 1, None, 4, 5), tuple(storage.get(k) for k in "abcde"))
+
+    def test_log_format_compacts(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_log_format(True)
+        for i in range(20):
+            storage.put("a", "x" * (i + 50))
+            storage.write()
+        with open(self.wallet_path, "r") as f:
+            lines = f.read().splitlines()
+        self.assertLess(len(lines), 20)
+        self.assertEqual("x" * 69, WalletStorage(self.wallet_path).get("a"))
+
+    def test_log_format_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_log_format(True)
+        storage.set_password("secret", True)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted())
+        storage.decrypt("secret")
+        self.assertEqual("c", storage.get("a"))
+
+
+class TestWalletAutosave(WalletTestCase):
+
+    def test_saves_changed_state_only(self):
+        from lib.wallet import Imported_Wallet
+        storage = WalletStorage(self.wallet_path)
+        wallet = Imported_Wallet(storage)
+        storage.write()
+        wallet.save_changed_state()
+        self.assertFalse(storage.modified)
+
+        with wallet.lock:
+            wallet.history["addr"] = [("ab", 1)]
+        wallet.schedule_autosave()
+        wallet.save_changed_state()
+        self.assertFalse(wallet.state_changed)
+        self.assertIn("addr_history", storage.dirty_keys)
+
+
+class TestParsedTxCache(unittest.TestCase):
+
+    def _make_tx(self):
+        from lib.transaction import Transaction
+        from lib.tests.test_transaction import signed_blob
+        tx = Transaction(signed_blob)
+        tx.deserialize()
+        return tx
+
+    def test_evicts_least_recently_used(self):
+        from lib.wallet import ParsedTxCache
+        size = len(self._make_tx().raw) // 2
+        cache = ParsedTxCache(max_size=2 * size)
+        txs = [self._make_tx() for i in range(3)]
+        cache.touch('a', txs[0])
+        cache.touch('b', txs[1])
+        cache.touch('a', txs[0])
+        cache.touch('c', txs[2])
+        self.assertEqual(2, len(cache))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertTrue(txs[0].is_parsed())
+        self.assertFalse(txs[1].is_parsed())
+        self.assertEqual(2 * size, cache.size)
+
+    def test_clear_history_clears_cache(self):
+        from lib.wallet import Imported_Wallet
+        wallet = Imported_Wallet(WalletStorage('/nonexistent/wallet'))
+        tx = self._make_tx()
+        wallet.transactions['ab'] = tx
+        wallet.get_transaction('ab')
+        self.assertIn('ab', wallet.tx_cache)
+        wallet.clear_history()
+        self.assertEqual(0, len(wallet.tx_cache))
+        self.assertIsNone(wallet.get_transaction('ab'))
+
+    def test_unloaded_tx_reparses(self):
+        tx = self._make_tx()
+        outputs = tx.outputs()
+        tx.unload()
+        self.assertFalse(tx.is_parsed())
+        self.assertEqual(outputs, tx.outputs())
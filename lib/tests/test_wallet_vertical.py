@@ -182,3 +182,85 @@ class TestWalletKeystoreAddressIntegrity(unittest.TestCase):
         self.assertEqual(w.get_receiving_addresses()[0], '3H3iyACDTLJGD2RMjwKZcCwpdYZLwEZzKb')
         self.assertEqual(w.get_change_addresses()[0], '31hyfHrkhNjiPZp1t7oky5CGNYqSqDAVM9')
 
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_batched_address_derivation(self, mock_write):
+        xpub = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+        ks = keystore.from_xpub(xpub)
+        serial = [ks.derive_pubkey(False, n) for n in range(3, 11)]
+        # fresh keystores, which have not cached these pubkeys
+        self.assertEqual(keystore.from_xpub(xpub).derive_pubkeys(False, 3, 8), serial)
+        self.assertEqual(keystore.from_xpub(xpub).derive_pubkeys(False, 3, 8, processes=2), serial)
+
+        w = self._create_standard_wallet(ks)
+        self.assertEqual(w.get_receiving_addresses()[0], '1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf')
+        self.assertEqual(len(w.get_receiving_addresses()), self.gap_limit)
+        w.create_new_addresses(False, 4)
+        self.assertEqual(w.get_receiving_addresses()[3:],
+                         [bitcoin.pubkey_to_address('p2pkh', x) for x in serial[:2]])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_pubkey_cache(self, mock_write):
+        xpub = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+        ks = keystore.from_xpub(xpub)
+        with mock.patch.object(keystore, 'CKD_pub', wraps=bitcoin.CKD_pub) as ckd:
+            pubkey = ks.derive_pubkey(True, 5)
+            self.assertEqual(pubkey, ks.derive_pubkey(True, 5))
+            self.assertEqual([pubkey], ks.derive_pubkeys(True, 5, 1))
+            self.assertEqual(1, ckd.call_count)
+        self.assertEqual(pubkey, keystore.from_xpub(xpub).derive_pubkey(True, 5))
+
+        with mock.patch.object(wallet.Deterministic_Wallet, 'persist_pubkeys', True):
+            w = self._create_standard_wallet(ks)
+        receiving, change = w.storage.get('pubkey_cache')[xpub]
+        self.assertEqual(w.get_public_key(w.get_receiving_addresses()[0]), receiving[0])
+        w2 = wallet.Standard_Wallet(w.storage)
+        with mock.patch.object(keystore, 'CKD_pub', wraps=bitcoin.CKD_pub) as ckd:
+            self.assertEqual(w.get_receiving_addresses(), w2.get_receiving_addresses())
+            w2.get_public_key(w2.get_receiving_addresses()[0])
+            self.assertEqual(0, ckd.call_count)
+        # the cache is removed from the file when it is not wanted
+        w2.save_addresses()
+        self.assertIsNone(w2.storage.get('pubkey_cache'))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_batch_transactions(self, mock_write):
+        ks = keystore.from_seed('cycle rocket west magnet parrot shuffle foot correct salt library feed song', '', False)
+        w = self._create_standard_wallet(ks)
+        addr = w.get_receiving_addresses()[0]
+        coins = [{'address': addr, 'value': 1000000, 'prevout_hash': '%064x' % (i + 1), 'prevout_n': 0,
+                  'height': 100, 'coinbase': False} for i in range(2)]
+        outputs = [(bitcoin.TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 200000)] * 7
+        signed = []
+        def sign(txs):
+            signed.extend(txs)
+            w.sign_transactions(txs, None)
+        txs = w.make_batch_transactions(coins, outputs, {}, 10000, max_outputs=3, sign=sign)
+        self.assertEqual([3, 3, 1], [len([o for o in tx.outputs() if o[1] != addr]) for tx in txs])
+        self.assertEqual(txs, signed)
+        self.assertTrue(all(tx.is_complete() for tx in txs))
+        spent = [(txin['prevout_hash'], txin['prevout_n']) for tx in txs for txin in tx.inputs()]
+        self.assertEqual(len(spent), len(set(spent)))
+        # the coins ran out, so the last transaction spends change
+        self.assertTrue(set(txin['prevout_hash'] for txin in txs[2].inputs()) <= set(tx.txid() for tx in txs[:2]))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_batch_transactions_use_change(self, mock_write):
+        ks = keystore.from_seed('cycle rocket west magnet parrot shuffle foot correct salt library feed song', '', False)
+        w = self._create_standard_wallet(ks)
+        w.use_change = True
+        addr = w.get_receiving_addresses()[0]
+        coins = [{'address': addr, 'value': 1000000, 'prevout_hash': '%064x' % (i + 1), 'prevout_n': 0,
+                  'height': 100, 'coinbase': False} for i in range(8)]
+        outputs = [(bitcoin.TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 200000)] * 8
+        self.assertEqual(6, len(w.get_change_addresses()))
+        txs = w.make_batch_transactions(coins, outputs, {}, 10000, max_outputs=1)
+        change = [o[1] for tx in txs for o in tx.outputs() if w.is_change(o[1])]
+        # one change address per transaction, derived past the gap limit
+        self.assertEqual(8, len(set(change)))
+        self.assertEqual(w.get_change_addresses()[:8], change)
+        self.assertEqual(8, len(w.get_change_addresses()))
+        # an explicit change address is used for all of them
+        change_addr = w.get_change_addresses()[0]
+        txs = w.make_batch_transactions(coins, outputs[:2], {}, 10000, change_addr)
+        self.assertEqual([change_addr], [o[1] for tx in txs for o in tx.outputs() if w.is_mine(o[1])])
@@ -27,11 +27,13 @@
 
 # Note: The deserialization code originally comes from ABE.
 
-from .util import print_error, profiler
+from .util import print_error, print_debug, LazyStr
 
 from . import bitcoin
 from .bitcoin import *
+import hashlib
 import struct
+import threading
 
 #
 # Workalike python implementation of Bitcoin's CDataStream class.
@@ -40,6 +42,23 @@ from .keystore import xpubkey_to_address, xpubkey_to_pubkey
 
 NO_SIGNATURE = 'ff'
 
+# Partial transactions: the magic, then key-value maps as in BIP 174,
+# a global one with the unsigned tx and one per input.  A record is a
+# key (type byte and key data) and a value, each prefixed with its
+# compact size; a map ends with an empty key.
+PARTIAL_TX_MAGIC = b'ptx\xff'
+PARTIAL_TX_PREFIX = '707478ff'
+PARTIAL_TX_UNSIGNED = 0x00
+PARTIAL_IN_TYPE = 0x00
+PARTIAL_IN_VALUE = 0x01
+PARTIAL_IN_ADDRESS = 0x02
+PARTIAL_IN_NUM_SIG = 0x03
+PARTIAL_IN_PUBKEY = 0x04       # key: pubkey, value: x_pubkey if not the pubkey
+PARTIAL_IN_SIGNATURE = 0x05    # key: slot, value: signature or empty
+PARTIAL_IN_REDEEM_SCRIPT = 0x06
+PARTIAL_IN_SCRIPTSIG = 0x07    # inputs the wallet cannot sign
+PARTIAL_IN_PREV_TX = 0x08      # the tx spent by a non-segwit input, without witness
+
 
 class SerializationError(Exception):
     """ Thrown when there's a problem deserializing or serializing """
@@ -60,6 +79,12 @@ class BCDataStream(object):
         else:
             self.input += bytearray(_bytes)
 
+    def read_from(self, _bytes):
+        """Read _bytes in place: read_bytes returns memoryview slices
+        of them instead of copies.  The stream cannot be written to."""
+        self.input = memoryview(_bytes)
+        self.read_cursor = 0
+
     def read_string(self, encoding='ascii'):
         # Strings are encoded depending on length:
         # 0 to 252 :  1-byte-length followed by bytes (if any)
@@ -73,7 +98,7 @@ class BCDataStream(object):
 
         length = self.read_compact_size()
 
-        return self.read_bytes(length).decode(encoding)
+        return bytes(self.read_bytes(length)).decode(encoding)
 
     def write_string(self, string, encoding='ascii'):
         string = to_bytes(string, encoding)
@@ -149,6 +174,39 @@ class BCDataStream(object):
         self.write(s)
 
 
+def compact_size(n):
+    '''Bytes of the compact size encoding of n, as var_int in hex.'''
+    if n < 0xfd:
+        return bytes((n,))
+    elif n <= 0xffff:
+        return b'\xfd' + struct.pack('<H', n)
+    elif n <= 0xffffffff:
+        return b'\xfe' + struct.pack('<I', n)
+    else:
+        return b'\xff' + struct.pack('<Q', n)
+
+
+def add_partial_record(buf, key_type, key_data, value):
+    key = bytes((key_type,)) + key_data
+    buf += compact_size(len(key)) + key + compact_size(len(value)) + value
+
+
+def read_partial_map(vds):
+    '''Records of a partial transaction map, as (key type, key data,
+    value), up to the end of the map.'''
+    records = []
+    while True:
+        n = vds.read_compact_size()
+        if n == 0:
+            return records
+        key = bytes(vds.read_bytes(n))
+        m = vds.read_compact_size()
+        value = bytes(vds.read_bytes(m))
+        if len(key) != n or len(value) != m:
+            raise SerializationError("attempt to read past end of buffer")
+        records.append((key[0], key[1:], value))
+
+
 # enum-like type
 # From the Python Cookbook, downloaded from http://code.activestate.com/recipes/67107/
 class EnumException(Exception):
@@ -281,6 +339,16 @@ def match_decoded(decoded, to_match):
     return True
 
 
+def sign_preimage_hash(sec, compressed, pre_hash):
+    '''Signature of an input, with its hash type, and the pubkey of sec.
+    Also called in worker processes by Transaction.sign.'''
+    pkey = regenerate_key(sec)
+    pubkey = pkey.get_public_key(compressed)
+    sig = bitcoin.ecdsa_sign(pkey.secret, pre_hash)
+    assert bitcoin.ecdsa_verify(bfh(pubkey), sig, pre_hash)
+    return bh2u(sig) + '01', pubkey
+
+
 def parse_sig(x_sig):
     return [None if x == NO_SIGNATURE else x for x in x_sig]
 
@@ -291,18 +359,27 @@ def safe_parse_pubkey(x):
         return x
 
 def parse_scriptSig(d, _bytes):
-    try:
-        decoded = [ x for x in script_GetOp(_bytes) ]
-    except Exception as e:
-        # coinbase transactions raise an exception
-        print_error("cannot find address in input script", bh2u(_bytes))
-        return
+    # fast path for one or two direct pushes, as in p2pk, nested
+    # segwit and p2pkh inputs
+    n = len(_bytes)
+    k = 1 + _bytes[0] if n else 0
+    if 1 < k <= 0x4c and k == n:
+        decoded = [(k - 1, _bytes[1:k], k)]
+    elif 1 < k <= 0x4c and k < n and 0 < _bytes[k] < 0x4c and k + 1 + _bytes[k] == n:
+        decoded = [(k - 1, _bytes[1:k], k), (_bytes[k], _bytes[k+1:], n)]
+    else:
+        try:
+            decoded = [ x for x in script_GetOp(_bytes) ]
+        except Exception as e:
+            # coinbase transactions raise an exception
+            print_error("cannot find address in input script", LazyStr(bh2u, _bytes))
+            return
 
     match = [ opcodes.OP_PUSHDATA4 ]
     if match_decoded(decoded, match):
         item = decoded[0][1]
         if item[0] == 0:
-            d['address'] = bitcoin.hash160_to_p2sh(bitcoin.hash_160(item))
+            d['address'] = bitcoin.hash160_to_p2sh(bitcoin.hash_160(bytes(item)))
             d['type'] = 'p2wpkh-p2sh' if len(item) == 22 else 'p2wsh-p2sh'
         else:
             # payto_pubkey
@@ -325,7 +402,7 @@ def parse_scriptSig(d, _bytes):
             signatures = parse_sig([sig])
             pubkey, address = xpubkey_to_address(x_pubkey)
         except:
-            print_error("cannot find address in input script", bh2u(_bytes))
+            print_error("cannot find address in input script", LazyStr(bh2u, _bytes))
             return
         d['type'] = 'p2pkh'
         d['signatures'] = signatures
@@ -338,7 +415,7 @@ def parse_scriptSig(d, _bytes):
     # p2sh transaction, m of n
     match = [ opcodes.OP_0 ] + [ opcodes.OP_PUSHDATA4 ] * (len(decoded) - 1)
     if not match_decoded(decoded, match):
-        print_error("cannot find address in input script", bh2u(_bytes))
+        print_error("cannot find address in input script", LazyStr(bh2u, _bytes))
         return
     x_sig = [bh2u(x[1]) for x in decoded[1:-1]]
     m, n, x_pubkeys, pubkeys, redeemScript = parse_redeemScript(decoded[-1][1])
@@ -360,7 +437,7 @@ def parse_redeemScript(s):
     op_n = opcodes.OP_1 + n - 1
     match_multisig = [ op_m ] + [opcodes.OP_PUSHDATA4]*n + [ op_n, opcodes.OP_CHECKMULTISIG ]
     if not match_decoded(dec2, match_multisig):
-        print_error("cannot find address in input script", bh2u(s))
+        print_error("cannot find address in input script", LazyStr(bh2u, s))
         return
     x_pubkeys = [bh2u(x[1]) for x in dec2[1:-2]]
     pubkeys = [safe_parse_pubkey(x) for x in x_pubkeys]
@@ -368,6 +445,21 @@ def parse_redeemScript(s):
     return m, n, x_pubkeys, pubkeys, redeemScript
 
 def get_address_from_output_script(_bytes):
+    # fast paths for the standard forms of the templates below
+    n = len(_bytes)
+    if n == 25 and _bytes[:3] == b'\x76\xa9\x14' and _bytes[23:] == b'\x88\xac':
+        return TYPE_ADDRESS, hash160_to_p2pkh(_bytes[3:23])
+    if n == 23 and _bytes[:2] == b'\xa9\x14' and _bytes[22] == 0x87:
+        return TYPE_ADDRESS, hash160_to_p2sh(_bytes[2:22])
+    if (n == 22 and _bytes[:2] == b'\x00\x14') or (n == 34 and _bytes[:2] == b'\x00\x20'):
+        return TYPE_ADDRESS, hash_to_segwit_addr(_bytes[2:])
+    if ((n == 35 and _bytes[0] == 0x21) or (n == 67 and _bytes[0] == 0x41)) and _bytes[-1] == 0xac:
+        return TYPE_PUBKEY, bh2u(_bytes[1:-1])
+    if n and _bytes[0] == opcodes.OP_RETURN:
+        # data outputs, such as the LBTC register and vote outputs,
+        # match none of the templates
+        return TYPE_SCRIPT, bh2u(_bytes)
+
     decoded = [x for x in script_GetOp(_bytes)]
 
     # The Genesis Block, self-payments, and pay-by-IP-address payments look like:
@@ -397,8 +489,9 @@ def get_address_from_output_script(_bytes):
 
 def parse_input(vds):
     d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
+    prevout_hash = hash_encode(bytes(vds.read_bytes(32)))
     prevout_n = vds.read_uint32()
+    # parsed from the view, without a copy
     scriptSig = vds.read_bytes(vds.read_compact_size())
     sequence = vds.read_uint32()
     d['prevout_hash'] = prevout_hash
@@ -446,19 +539,43 @@ def parse_witness(vds, txin):
         txin['pubkeys'] = [safe_parse_pubkey(w[1])]
         txin['signatures'] = parse_sig([w[0]])
 
-def parse_output(vds, i):
-    d = {}
-    d['value'] = vds.read_int64()
+class ParsedOutput(dict):
+    '''Parsed output whose 'scriptPubKey' hex is only made from the
+    script when it is looked up.'''
+
+    def __init__(self, script):
+        dict.__init__(self)
+        self.script = script
+
+    def __missing__(self, key):
+        if key != 'scriptPubKey':
+            raise KeyError(key)
+        value = self[key] = bh2u(self.script)
+        self.script = None
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self or key == 'scriptPubKey' else default
+
+
+def parse_output(vds, i, scripts=True):
+    value = vds.read_int64()
     scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    d = {} if scripts else ParsedOutput(scriptPubKey)
+    d['value'] = value
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
-    d['scriptPubKey'] = bh2u(scriptPubKey)
+    if scripts:
+        d['scriptPubKey'] = bh2u(scriptPubKey)
     d['prevout_n'] = i
     return d
 
 
-def deserialize(raw):
+def deserialize(raw, scripts=True):
+    """Parse a raw transaction in hex.  With scripts=False the hex of
+    the output scripts is only made when it is looked up, for callers
+    that mostly need their address."""
     vds = BCDataStream()
-    vds.write(bfh(raw))
+    vds.read_from(bfh(raw))
     d = {}
     start = vds.read_cursor
     d['version'] = vds.read_int32()
@@ -470,7 +587,7 @@ def deserialize(raw):
         n_vin = vds.read_compact_size()
     d['inputs'] = [parse_input(vds) for i in range(n_vin)]
     n_vout = vds.read_compact_size()
-    d['outputs'] = [parse_output(vds, i) for i in range(n_vout)]
+    d['outputs'] = [parse_output(vds, i, scripts) for i in range(n_vout)]
     if is_segwit:
         for i in range(n_vin):
             txin = d['inputs'][i]
@@ -501,6 +618,9 @@ def multisig_script(public_keys, m):
     return op_m + ''.join(keylist) + op_n + 'ae'
 
 
+# held while the parsed inputs and outputs of a transaction are loaded
+# or unloaded
+_parse_lock = threading.Lock()
 
 
 class Transaction:
@@ -524,21 +644,62 @@ class Transaction:
         self.locktime = 0
         #self.version = 0xff01 # first lbtc version
         self.version = 0xff02 # second lbtc version
+        self._cache = {}
+        if self.raw is not None and self.raw.startswith(PARTIAL_TX_PREFIX):
+            partial, self.raw = bfh(self.raw), None
+            self.load_partial(partial)
+
+    def invalidate_cache(self):
+        '''Forget the txid and sizes computed so far.  Needed after
+        changing inputs or outputs in place without setting raw.'''
+        self._cache = {}
+
+    def _cached(self, name, f):
+        # entries are valid for the raw and locktime they were made with
+        cache = self._cache
+        if cache.get('raw', cache) is not self.raw or cache.get('locktime') != self.locktime:
+            cache.clear()
+            cache['raw'] = self.raw
+            cache['locktime'] = self.locktime
+        if name not in cache:
+            cache[name] = f()
+        return cache[name]
 
     def update(self, raw):
         self.raw = raw
         self._inputs = None
-        self.deserialize()
+        self.invalidate_cache()
+        self.deserialize(scripts=False)
+
+    def is_parsed(self):
+        return self._inputs is not None
+
+    def unload(self):
+        '''Drop the parsed inputs and outputs, keeping the raw hex.
+        They are parsed again the next time they are requested.'''
+        with _parse_lock:
+            if self.raw is None:
+                return
+            self._inputs = None
+            self._outputs = None
 
     def inputs(self):
-        if self._inputs is None:
-            self.deserialize()
-        return self._inputs
+        inputs = self._inputs
+        if inputs is None:
+            # unload() may run in another thread, e.g. when the wallet
+            # evicts the transaction from its cache
+            with _parse_lock:
+                self.deserialize(scripts=False)
+                inputs = self._inputs
+        return inputs
 
     def outputs(self):
-        if self._outputs is None:
-            self.deserialize()
-        return self._outputs
+        outputs = self._outputs
+        if outputs is None:
+            with _parse_lock:
+                self.deserialize(scripts=False)
+                outputs = self._outputs
+        return outputs
 
     @classmethod
     def get_sorted_pubkeys(self, txin):
@@ -554,7 +715,8 @@ class Transaction:
 
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
-        d = deserialize(raw)
+        d = deserialize(raw, scripts=False)
+        parts = None
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sigs1 = txin.get('signatures')
@@ -562,32 +724,35 @@ class Transaction:
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                pre_hash = Hash(bfh(self.serialize_preimage(i)))
+                if parts is None:
+                    parts = self.get_preimage_parts()
+                pre_hash = Hash(self.serialize_preimage_bytes(i, parts))
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(bfh(sig[:-2]), order)
                 sig_string = ecdsa.util.sigencode_string(r, s, order)
                 compressed = True
                 for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, pre_hash, curve = SECP256k1)
-                    pubkey = bh2u(point_to_ser(public_key.pubkey.point, compressed))
+                    pubkey = bh2u(bitcoin.ecdsa_recover(sig_string, recid, pre_hash, compressed))
                     if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, pre_hash, sigdecode = ecdsa.util.sigdecode_string)
+                        if not bitcoin.ecdsa_verify(bfh(pubkey), bfh(sig[:-2]), pre_hash):
+                            raise Exception("Bad signature")
                         j = pubkeys.index(pubkey)
-                        print_error("adding sig", i, j, pubkey, sig)
+                        print_debug("adding sig", i, j, pubkey, sig)
                         self._inputs[i]['signatures'][j] = sig
                         #self._inputs[i]['x_pubkeys'][j] = pubkey
                         break
         # redo raw
+        self.invalidate_cache()
         self.raw = self.serialize()
 
-    def deserialize(self):
+    def deserialize(self, scripts=True):
         if self.raw is None:
             return
             #self.raw = self.serialize()
         if self._inputs is not None:
             return
-        d = deserialize(self.raw)
+        d = deserialize(self.raw, scripts)
         self._inputs = d['inputs']
         self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
@@ -664,23 +829,27 @@ class Transaction:
 
     @classmethod
     def serialize_witness(self, txin, estimate_size=False):
-        add_w = lambda x: var_int(len(x)//2) + x
+        return bh2u(self.serialize_witness_bytes(txin, estimate_size))
+
+    @classmethod
+    def serialize_witness_bytes(self, txin, estimate_size=False):
+        def add_w(x):
+            x = bfh(x)
+            return compact_size(len(x)) + x
         if not self.is_segwit_input(txin):
-            return '00'
+            return b'\x00'
         pubkeys, sig_list = self.get_siglist(txin, estimate_size)
         if txin['type'] in ['p2wpkh', 'p2wpkh-p2sh']:
-            witness = var_int(2) + add_w(sig_list[0]) + add_w(pubkeys[0])
+            witness = [b'\x02', add_w(sig_list[0]), add_w(pubkeys[0])]
         elif txin['type'] in ['p2wsh', 'p2wsh-p2sh']:
             n = len(sig_list) + 2
             witness_script = multisig_script(pubkeys, txin['num_sig'])
-            witness = var_int(n) + '00' + ''.join(add_w(x) for x in sig_list) + add_w(witness_script)
+            witness = [compact_size(n), b'\x00'] + [add_w(x) for x in sig_list] + [add_w(witness_script)]
         else:
             raise BaseException('wrong txin type')
-        if self.is_txin_complete(txin) or estimate_size:
-            value_field = ''
-        else:
-            value_field = var_int(0xffffffff) + int_to_hex(txin['value'], 8)
-        return value_field + witness
+        if not (self.is_txin_complete(txin) or estimate_size):
+            witness.insert(0, compact_size(0xffffffff) + struct.pack('<Q', txin['value']))
+        return b''.join(witness)
 
     @classmethod
     def is_segwit_input(self, txin):
@@ -745,105 +914,180 @@ class Transaction:
 
     @classmethod
     def serialize_outpoint(self, txin):
-        return bh2u(bfh(txin['prevout_hash'])[::-1]) + int_to_hex(txin['prevout_n'], 4)
+        return bh2u(self.serialize_outpoint_bytes(txin))
+
+    @classmethod
+    def serialize_outpoint_bytes(self, txin):
+        return bfh(txin['prevout_hash'])[::-1] + struct.pack('<I', txin['prevout_n'])
 
     @classmethod
     def serialize_input(self, txin, script):
-        # Prev hash and index
-        s = self.serialize_outpoint(txin)
-        # Script length, script, sequence
-        s += var_int(len(script)//2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        return s
+        return bh2u(self.serialize_input_bytes(txin, bfh(script)))
+
+    @classmethod
+    def serialize_input_bytes(self, txin, script):
+        # Prev hash and index, script length, script, sequence
+        return b''.join((self.serialize_outpoint_bytes(txin),
+                         compact_size(len(script)),
+                         script,
+                         struct.pack('<I', txin.get('sequence', 0xffffffff - 1))))
 
     def set_rbf(self, rbf):
         nSequence = 0xffffffff - (2 if rbf else 1)
         for txin in self.inputs():
             txin['sequence'] = nSequence
+        self.invalidate_cache()
 
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[0], o[1])))
+        self.invalidate_cache()
 
     def serialize_output(self, output):
+        return bh2u(self.serialize_output_bytes(output))
+
+    def serialize_output_bytes(self, output):
         output_type, addr, amount = output
-        s = int_to_hex(amount, 8)
-        script = self.pay_script(output_type, addr)
-        s += var_int(len(script)//2)
-        s += script
-        return s
-
-    def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(1, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        script = bfh(self.pay_script(output_type, addr))
+        return struct.pack('<Q', amount) + compact_size(len(script)) + script
+
+    def get_preimage_parts(self):
+        '''Parts of the signature preimages that are the same for all
+        inputs, to be passed to serialize_preimage_bytes.'''
         inputs = self.inputs()
         outputs = self.outputs()
+        txouts = [self.serialize_output_bytes(o) for o in outputs]
+        end = struct.pack('<II', self.locktime, 1)  # locktime, hash type
+        if self.version >= 0xff02:
+            end += struct.pack('<I', 0x4354424c)
+        parts = {
+            'version': struct.pack('<i', self.version),
+            'txouts': compact_size(len(outputs)) + b''.join(txouts),
+            'end': end,
+        }
+        if any(self.is_segwit_input(txin) for txin in inputs):
+            parts['hashPrevouts'] = Hash(b''.join(self.serialize_outpoint_bytes(txin) for txin in inputs))
+            parts['hashSequence'] = Hash(b''.join(struct.pack('<I', txin.get('sequence', 0xffffffff - 1)) for txin in inputs))
+            parts['hashOutputs'] = Hash(b''.join(txouts))
+        if not all(self.is_segwit_input(txin) for txin in inputs):
+            # inputs with an empty script, input i is at txins[offsets[i]:offsets[i+1]]
+            txins = [self.serialize_input_bytes(txin, b'') for txin in inputs]
+            offsets = [0]
+            for x in txins:
+                offsets.append(offsets[-1] + len(x))
+            parts['txins'] = b''.join(txins)
+            parts['offsets'] = offsets
+        return parts
+
+    def serialize_preimage(self, i, parts=None):
+        preimage = bh2u(self.serialize_preimage_bytes(i, parts))
+        print_debug("preimage", preimage)
+        return preimage
+
+    def serialize_preimage_bytes(self, i, parts=None):
+        inputs = self.inputs()
         txin = inputs[i]
-        # TODO: py3 hex
+        if parts is None:
+            parts = self.get_preimage_parts()
         if self.is_segwit_input(txin):
-            hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-            hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-            hashOutputs = bh2u(Hash(bfh(''.join(self.serialize_output(o) for o in outputs))))
-            outpoint = self.serialize_outpoint(txin)
-            preimage_script = self.get_preimage_script(txin)
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin['value'], 8)
-            nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
+            outpoint = self.serialize_outpoint_bytes(txin)
+            preimage_script = bfh(self.get_preimage_script(txin))
+            scriptCode = compact_size(len(preimage_script)) + preimage_script
+            amount = struct.pack('<Q', txin['value'])
+            nSequence = struct.pack('<I', txin.get('sequence', 0xffffffff - 1))
+            preimage = [parts['version'], parts['hashPrevouts'], parts['hashSequence'], outpoint, scriptCode, amount, nSequence, parts['hashOutputs']]
         else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
-
-        print_error("before preimage", preimage)
-        if self.version >= 0xff02 :
-            preimage = preimage + int_to_hex(0x4354424c, 4)
-        print_error("after preimage", preimage)
-        return preimage
+            txins, offsets = parts['txins'], parts['offsets']
+            txin_bytes = self.serialize_input_bytes(txin, bfh(self.get_preimage_script(txin)))
+            preimage = [parts['version'], compact_size(len(inputs)), txins[:offsets[i]], txin_bytes, txins[offsets[i+1]:], parts['txouts']]
+        preimage.append(parts['end'])
+        return b''.join(preimage)
+
+    def get_preimage_hashes(self, indices, parts=None):
+        '''Hashes to sign of the inputs at indices, as a dict.  The
+        preimages of legacy inputs only differ by the script of the
+        signed input, so the sha256 state of their common start is
+        carried from one input to the next, and the rest is hashed
+        straight from the shared parts.'''
+        inputs = self.inputs()
+        if parts is None:
+            parts = self.get_preimage_parts()
+        hashes = {}
+        legacy = []
+        for i in sorted(set(indices)):
+            if self.is_segwit_input(inputs[i]):
+                hashes[i] = Hash(self.serialize_preimage_bytes(i, parts))
+            else:
+                legacy.append(i)
+        if not legacy:
+            return hashes
+        txins, offsets = memoryview(parts['txins']), parts['offsets']
+        start = hashlib.sha256(parts['version'] + compact_size(len(inputs)))
+        pos = 0
+        for i in legacy:
+            start.update(txins[pos:offsets[i]])
+            pos = offsets[i]
+            h = start.copy()
+            txin = inputs[i]
+            h.update(self.serialize_input_bytes(txin, bfh(self.get_preimage_script(txin))))
+            h.update(txins[offsets[i+1]:])
+            h.update(parts['txouts'])
+            h.update(parts['end'])
+            hashes[i] = sha256(h.digest())
+        return hashes
 
     def is_segwit(self):
         return any(self.is_segwit_input(x) for x in self.inputs())
 
     def serialize(self, estimate_size=False, witness=True):
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        return bh2u(self.serialize_bytes(estimate_size, witness))
+
+    def serialize_bytes(self, estimate_size=False, witness=True):
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size)) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-        if witness and self.is_segwit():
-            marker = '00'
-            flag = '01'
-            witness = ''.join(self.serialize_witness(x, estimate_size) for x in inputs)
-            return nVersion + marker + flag + txins + txouts + witness + nLocktime
-        else:
-            return nVersion + txins + txouts + nLocktime
+        witness = witness and self.is_segwit()
+        buf = bytearray(struct.pack('<i', self.version))
+        if witness:
+            # marker and flag
+            buf += b'\x00\x01'
+        buf += compact_size(len(inputs))
+        for txin in inputs:
+            buf += self.serialize_input_bytes(txin, bfh(self.input_script(txin, estimate_size)))
+        buf += compact_size(len(outputs))
+        for o in outputs:
+            buf += self.serialize_output_bytes(o)
+        if witness:
+            for txin in inputs:
+                buf += self.serialize_witness_bytes(txin, estimate_size)
+        buf += struct.pack('<I', self.locktime)
+        return bytes(buf)
 
     def hash(self):
         print("warning: deprecated tx.hash()")
         return self.txid()
 
     def txid(self):
+        return self._cached('txid', self._txid)
+
+    def _txid(self):
         all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
         if not all_segwit and not self.is_complete():
             return None
-        ser = self.serialize(witness=False)
-        return bh2u(Hash(bfh(ser))[::-1])
+        return bh2u(Hash(self.serialize_bytes(witness=False))[::-1])
 
     def wtxid(self):
-        ser = self.serialize(witness=True)
-        return bh2u(Hash(bfh(ser))[::-1])
+        return self._cached('wtxid', lambda: bh2u(Hash(self.serialize_bytes(witness=True))[::-1]))
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self.invalidate_cache()
 
     def add_outputs(self, outputs):
         self._outputs.extend(outputs)
         self.raw = None
+        self.invalidate_cache()
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -857,7 +1101,6 @@ class Transaction:
     def is_final(self):
         return not any([x.get('sequence', 0xffffffff - 1) < 0xffffffff - 1 for x in self.inputs()])
 
-    @profiler
     def estimated_size(self):
         """Return an estimated virtual tx size in vbytes.
         BIP-0141 defines 'Virtual transaction size' to be weight/4 rounded up.
@@ -871,35 +1114,109 @@ class Transaction:
     @classmethod
     def estimated_input_weight(cls, txin):
         '''Return an estimate of serialized input weight in weight units.'''
-        script = cls.input_script(txin, True)
-        input_size = len(cls.serialize_input(txin, script)) // 2
+        input_size = cls.estimated_input_size(txin)
 
         # note: we should actually branch based on tx.is_segwit()
         # only if none of the inputs have a witness, is the size actually 0
         if cls.is_segwit_input(txin):
-            witness_size = len(cls.serialize_witness(txin, True)) // 2
+            witness_size = cls.estimated_input_witness_size(txin)
         else:
             witness_size = 0
 
         return 4 * input_size + witness_size
 
+    # The sizes below are computed without serializing, and are those
+    # of serializing with estimate_size=True.
+
+    @classmethod
+    def estimated_multisig_script_size(cls, txin):
+        n = len(txin.get('x_pubkeys', [None]))
+        pubkey_size = cls.estimate_pubkey_size_for_txin(txin)
+        # OP_m, the pubkeys, OP_n, OP_CHECKMULTISIG
+        return 3 + n * (len(op_push(pubkey_size)) // 2 + pubkey_size)
+
+    @classmethod
+    def estimated_script_size(cls, txin):
+        '''Return the size of the scriptSig of txin in bytes.'''
+        _type = txin['type']
+        if _type in ['coinbase', 'unknown']:
+            return len(txin['scriptSig']) // 2
+        elif _type in ['p2wpkh', 'p2wsh']:
+            return 0
+        elif _type == 'p2wpkh-p2sh':
+            # push of OP_0 and a 20 byte hash
+            return 23
+        elif _type == 'p2wsh-p2sh':
+            # push of OP_0 and a 32 byte hash
+            return 35
+        # pushes of 0x48 byte signatures
+        sigs_size = txin.get('num_sig', 1) * 0x49
+        if _type == 'p2pk':
+            return sigs_size
+        elif _type in ['p2pkh', 'address']:
+            pubkey_size = cls.estimate_pubkey_size_for_txin(txin)
+            return sigs_size + len(op_push(pubkey_size)) // 2 + pubkey_size
+        elif _type == 'p2sh':
+            redeem_script_size = cls.estimated_multisig_script_size(txin)
+            return 1 + sigs_size + len(op_push(redeem_script_size)) // 2 + redeem_script_size
+        return len(cls.input_script(txin, True)) // 2
+
+    @classmethod
+    def estimated_input_size(cls, txin):
+        '''Return the size of txin without its witness in bytes.'''
+        script_size = cls.estimated_script_size(txin)
+        # outpoint, script, sequence
+        return 36 + len(compact_size(script_size)) + script_size + 4
+
+    @classmethod
+    def estimated_input_witness_size(cls, txin):
+        '''Return the size of the witness of txin in bytes.'''
+        _type = txin['type']
+        if _type in ['p2wpkh', 'p2wpkh-p2sh']:
+            pubkey_size = cls.estimate_pubkey_size_for_txin(txin)
+            # item count, signature, pubkey
+            return 1 + 0x49 + len(compact_size(pubkey_size)) + pubkey_size
+        elif _type in ['p2wsh', 'p2wsh-p2sh']:
+            num_sig = txin.get('num_sig', 1)
+            witness_script_size = cls.estimated_multisig_script_size(txin)
+            # item count, OP_0, signatures, witness script
+            return (len(compact_size(num_sig + 2)) + 1 + num_sig * 0x49
+                    + len(compact_size(witness_script_size)) + witness_script_size)
+        return len(cls.serialize_witness_bytes(txin, True))
+
+    @classmethod
+    def estimated_output_size(cls, output):
+        script_size = len(cls.pay_script(output[0], output[1])) // 2
+        return 8 + len(compact_size(script_size)) + script_size
+
     @classmethod
     def virtual_size_from_weight(cls, weight):
         return weight // 4 + (weight % 4 > 0)
 
     def estimated_total_size(self):
         """Return an estimated total transaction size in bytes."""
-        return len(self.serialize(True)) // 2 if not self.is_complete() or self.raw is None else len(self.raw) // 2  # ASCII hex string
+        if self.is_complete() and self.raw is not None:
+            return len(self.raw) // 2  # ASCII hex string
+        inputs = self.inputs()
+        outputs = self.outputs()
+        # version, locktime, inputs, outputs
+        size = 8 + len(compact_size(len(inputs))) + len(compact_size(len(outputs)))
+        size += sum(self.estimated_input_size(x) for x in inputs)
+        size += sum(self.estimated_output_size(o) for o in outputs)
+        if self.is_segwit():
+            size += 2 + sum(self.estimated_input_witness_size(x) for x in inputs)
+        return size
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
         if not self.is_segwit():
             return 0
         inputs = self.inputs()
-        estimate = not self.is_complete()
-        witness = ''.join(self.serialize_witness(x, estimate) for x in inputs)
-        witness_size = len(witness) // 2 + 2  # include marker and flag
-        return witness_size
+        if self.is_complete():
+            witness_size = sum(len(self.serialize_witness_bytes(x)) for x in inputs)
+        else:
+            witness_size = sum(self.estimated_input_witness_size(x) for x in inputs)
+        return witness_size + 2  # include marker and flag
 
     def estimated_base_size(self):
         """Return an estimated base transaction size in bytes."""
@@ -907,8 +1224,11 @@ class Transaction:
 
     def estimated_weight(self):
         """Return an estimate of transaction weight."""
+        return self._cached('weight', self._estimated_weight)
+
+    def _estimated_weight(self):
         total_tx_size = self.estimated_total_size()
-        base_tx_size = self.estimated_base_size()
+        base_tx_size = total_tx_size - self.estimated_witness_size()
         return 3 * base_tx_size + total_tx_size
 
     def signature_count(self):
@@ -926,32 +1246,44 @@ class Transaction:
         s, r = self.signature_count()
         return r == s
 
-    def sign(self, keypairs):
+    def sign(self, keypairs, processes=0):
+        '''With processes > 1 the inputs are signed by a pool of worker
+        processes.  Signatures are deterministic, so the transaction is
+        the same as when it is signed serially.'''
+        # the (input, slot, x_pubkey) to sign
+        jobs = []
         for i, txin in enumerate(self.inputs()):
-            num = txin['num_sig']
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            missing = txin['num_sig'] - len(list(filter(None, txin['signatures'])))
             for j, x_pubkey in enumerate(x_pubkeys):
-                signatures = list(filter(None, txin['signatures']))
-                if len(signatures) == num:
+                if missing <= 0:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
-                    print_error("adding signature for", x_pubkey)
-                    sec, compressed = keypairs.get(x_pubkey)
-                    pubkey = public_key_from_private_key(sec, compressed)
-                    # add signature
-                    pre_hash = Hash(bfh(self.serialize_preimage(i)))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-                    assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
-                    txin['signatures'][j] = bh2u(sig) + '01'
-                    #txin['x_pubkeys'][j] = pubkey
-                    txin['pubkeys'][j] = pubkey # needed for fd keys
-                    self._inputs[i] = txin
-        print_error("is_complete", self.is_complete())
+                if x_pubkey in keypairs:
+                    jobs.append((i, j, x_pubkey))
+                    if not txin['signatures'][j]:
+                        missing -= 1
+        # preimages do not depend on signatures, so they are all made first
+        pre_hashes = self.get_preimage_hashes([i for i, j, x_pubkey in jobs]) if jobs else {}
+        args = []
+        for i, j, x_pubkey in jobs:
+            sec, compressed = keypairs[x_pubkey]
+            args.append((sec, compressed, pre_hashes[i]))
+        if processes > 1 and len(jobs) >= 2 * processes:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(processes) as pool:
+                results = list(pool.map(sign_preimage_hash, *zip(*args),
+                                        chunksize=max(1, len(jobs) // (4 * processes))))
+        else:
+            results = [sign_preimage_hash(*a) for a in args]
+        for (i, j, x_pubkey), (sig, pubkey) in zip(jobs, results):
+            print_debug("adding signature for", x_pubkey)
+            txin = self._inputs[i]
+            txin['signatures'][j] = sig
+            #txin['x_pubkeys'][j] = pubkey
+            txin['pubkeys'][j] = pubkey # needed for fd keys
+        print_debug("is_complete", LazyStr(self.is_complete))
+        self.invalidate_cache()
         self.raw = self.serialize()
 
     def get_outputs(self):
@@ -974,10 +1306,165 @@ class Transaction:
     def has_address(self, addr):
         return (addr in self.get_output_addresses()) or (addr in (tx.get("address") for tx in self.inputs()))
 
+    @classmethod
+    def is_partial_signable(cls, txin):
+        return txin['type'] not in ['coinbase', 'unknown'] and '(pubkey)' not in txin['x_pubkeys']
+
+    def serialize_partial(self):
+        return bh2u(self.serialize_partial_bytes())
+
+    def serialize_partial_bytes(self):
+        '''The transaction in the partial transaction format.  Inputs
+        keep their pubkeys next to their extended pubkeys, and their
+        redeem script, so that loading it does not parse scripts nor
+        derive pubkeys.  Segwit inputs keep their value, as their
+        signature commits to it.  Non-segwit inputs keep the tx they
+        spend instead, if they have it as prev_tx, since their value
+        can only be trusted from it.'''
+        inputs = self.inputs()
+        outputs = self.outputs()
+        unsigned = bytearray(struct.pack('<i', self.version))
+        unsigned += compact_size(len(inputs))
+        for txin in inputs:
+            unsigned += self.serialize_input_bytes(txin, b'')
+        unsigned += compact_size(len(outputs))
+        for o in outputs:
+            unsigned += self.serialize_output_bytes(o)
+        unsigned += struct.pack('<I', self.locktime)
+        buf = bytearray(PARTIAL_TX_MAGIC)
+        add_partial_record(buf, PARTIAL_TX_UNSIGNED, b'', unsigned)
+        buf += b'\x00'
+        for txin in inputs:
+            add_partial_record(buf, PARTIAL_IN_TYPE, b'', txin['type'].encode('ascii'))
+            if not self.is_segwit_input(txin):
+                if txin.get('prev_tx'):
+                    add_partial_record(buf, PARTIAL_IN_PREV_TX, b'', txin['prev_tx'].serialize_bytes(witness=False))
+            elif txin.get('value') is not None:
+                add_partial_record(buf, PARTIAL_IN_VALUE, b'', struct.pack('<Q', txin['value']))
+            if txin.get('address'):
+                add_partial_record(buf, PARTIAL_IN_ADDRESS, b'', txin['address'].encode('ascii'))
+            if not self.is_partial_signable(txin):
+                add_partial_record(buf, PARTIAL_IN_SCRIPTSIG, b'', bfh(txin.get('scriptSig', '')))
+                buf += b'\x00'
+                continue
+            pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            add_partial_record(buf, PARTIAL_IN_NUM_SIG, b'', bytes((txin['num_sig'],)))
+            for pubkey, x_pubkey in zip(pubkeys, x_pubkeys):
+                add_partial_record(buf, PARTIAL_IN_PUBKEY, bfh(pubkey), b'' if x_pubkey == pubkey else bfh(x_pubkey))
+            # the signatures of complete inputs parsed from the hex format
+            # are not in the slots of their pubkeys, so they keep their own
+            for j, sig in enumerate(txin['signatures']):
+                add_partial_record(buf, PARTIAL_IN_SIGNATURE, compact_size(j), bfh(sig) if sig else b'')
+            if txin['type'] in ['p2sh', 'p2wsh', 'p2wsh-p2sh']:
+                add_partial_record(buf, PARTIAL_IN_REDEEM_SCRIPT, b'', bfh(self.get_preimage_script(txin)))
+            buf += b'\x00'
+        return bytes(buf)
+
+    @classmethod
+    def from_partial(klass, data):
+        '''Transaction from the partial transaction format, in bytes.
+        Transaction() also takes it in hex.'''
+        self = klass(None)
+        self.load_partial(data)
+        return self
+
+    def load_partial(self, data):
+        vds = BCDataStream()
+        vds.read_from(data)
+        if vds.read_bytes(len(PARTIAL_TX_MAGIC)) != PARTIAL_TX_MAGIC:
+            raise SerializationError("not a partial transaction")
+        unsigned = None
+        for key_type, key_data, value in read_partial_map(vds):
+            if key_type == PARTIAL_TX_UNSIGNED:
+                unsigned = value
+        if unsigned is None:
+            raise SerializationError("partial transaction without unsigned tx")
+        tx = BCDataStream()
+        tx.read_from(unsigned)
+        version = tx.read_int32()
+        inputs = []
+        for i in range(tx.read_compact_size()):
+            txin = {}
+            txin['prevout_hash'] = hash_encode(bytes(tx.read_bytes(32)))
+            txin['prevout_n'] = tx.read_uint32()
+            tx.read_bytes(tx.read_compact_size())
+            txin['sequence'] = tx.read_uint32()
+            inputs.append(txin)
+        outputs = [parse_output(tx, i, False) for i in range(tx.read_compact_size())]
+        locktime = tx.read_uint32()
+        for txin in inputs:
+            self.load_partial_input(txin, read_partial_map(vds))
+        self.raw = None
+        self._inputs = inputs
+        self._outputs = [(x['type'], x['address'], x['value']) for x in outputs]
+        self.locktime = locktime
+        self.version = version
+        self.invalidate_cache()
+
+    @classmethod
+    def load_partial_input(cls, txin, records):
+        txin['address'] = None
+        pubkeys = []
+        x_pubkeys = []
+        sigs = []
+        redeem_script = None
+        script_sig = None
+        amount = None
+        prev_tx = None
+        for key_type, key_data, value in records:
+            if key_type == PARTIAL_IN_TYPE:
+                txin['type'] = value.decode('ascii')
+            elif key_type == PARTIAL_IN_VALUE:
+                amount = struct.unpack('<Q', value)[0]
+            elif key_type == PARTIAL_IN_PREV_TX:
+                prev_tx = value
+            elif key_type == PARTIAL_IN_ADDRESS:
+                txin['address'] = value.decode('ascii')
+            elif key_type == PARTIAL_IN_NUM_SIG:
+                txin['num_sig'] = value[0]
+            elif key_type == PARTIAL_IN_PUBKEY:
+                pubkeys.append(bh2u(key_data))
+                x_pubkeys.append(bh2u(value or key_data))
+            elif key_type == PARTIAL_IN_SIGNATURE:
+                sigs.append(bh2u(value) if value else None)
+            elif key_type == PARTIAL_IN_REDEEM_SCRIPT:
+                redeem_script = bh2u(value)
+            elif key_type == PARTIAL_IN_SCRIPTSIG:
+                script_sig = value
+        if cls.is_segwit_input(txin):
+            if amount is not None:
+                txin['value'] = amount
+        elif prev_tx is not None:
+            # the value of a non-segwit input is not signed, so a
+            # cosigner could understate it to hide the fee.  It is
+            # only taken from the tx it spends, written without witness
+            # so that it hashes to the prevout hash.
+            if bh2u(Hash(prev_tx)[::-1]) != txin['prevout_hash']:
+                raise SerializationError("previous tx does not match input")
+            prev_tx = cls(bh2u(prev_tx))
+            outputs = prev_tx.outputs()
+            if txin['prevout_n'] >= len(outputs):
+                raise SerializationError("previous tx has no output %d" % txin['prevout_n'])
+            txin['value'] = outputs[txin['prevout_n']][2]
+            txin['prev_tx'] = prev_tx
+        if script_sig is not None:
+            # parsed as in the hex format
+            txin['scriptSig'] = bh2u(script_sig)
+            if txin['type'] != 'coinbase':
+                txin.update({'x_pubkeys': [], 'pubkeys': [], 'signatures': {}, 'num_sig': 0})
+                if script_sig:
+                    parse_scriptSig(txin, script_sig)
+            return
+        txin['pubkeys'] = pubkeys
+        txin['x_pubkeys'] = x_pubkeys
+        txin['signatures'] = sigs
+        if redeem_script is not None:
+            txin['witnessScript' if cls.is_segwit_input(txin) else 'redeemScript'] = redeem_script
+
     def as_dict(self):
         if self.raw is None:
             self.raw = self.serialize()
-        self.deserialize()
+        self.deserialize(scripts=False)
         out = {
             'hex': self.raw,
             'complete': self.is_complete(),
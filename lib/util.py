@@ -71,8 +71,13 @@ class PrintError(object):
         return self.__class__.__name__
 
     def print_error(self, *msg):
+        if not is_verbose: return
         print_error("[%s]" % self.diagnostic_name(), *msg)
 
+    def print_debug(self, *msg):
+        if verbosity < 2: return
+        print_debug("[%s]" % self.diagnostic_name(), *msg)
+
     def print_msg(self, *msg):
         print_msg("[%s]" % self.diagnostic_name(), *msg)
 
@@ -163,16 +168,37 @@ class DaemonThread(threading.Thread, PrintError):
 
 
 # TODO: disable
+# 0 prints nothing, 1 the print_error lines, 2 the print_debug lines too
+verbosity = 1
 is_verbose = True
-def set_verbosity(b):
-    global is_verbose
-    is_verbose = b
+def set_verbosity(level):
+    global is_verbose, verbosity
+    verbosity = int(level)
+    is_verbose = verbosity > 0
 
 
 def print_error(*args):
     if not is_verbose: return
     print_stderr(*args)
 
+def print_debug(*args):
+    '''For details printed per signature, input or message, which
+    are only shown at verbosity 2.'''
+    if verbosity < 2: return
+    print_stderr(*args)
+
+
+class LazyStr(object):
+    '''An argument of print_error or print_debug that is only computed
+    if the line is printed, e.g. LazyStr(bh2u, data).'''
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
 def print_stderr(*args):
     args = [str(item) for item in args]
     sys.stderr.write(" ".join(args) + "\n")
@@ -34,18 +34,24 @@ class SPV(ThreadJob):
         # Keyed by tx hash.  Value is None if the merkle branch was
         # requested, and the merkle root once it has been verified
         self.merkle_roots = {}
+        # Keyed by block height.  Headers that matched a merkle branch,
+        # so that other txs of the same block do not read it again
+        self.verified_headers = {}
 
     def run(self):
         lh = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
+        requests = []
+        # request by height, so that the txs of a block are verified together
+        for tx_hash, tx_height in sorted(unverified.items(), key=lambda x: x[1]):
             # do not request merkle branch before headers are available
             if (tx_height > 0) and (tx_hash not in self.merkle_roots) and (tx_height <= lh):
-                request = ('blockchain.transaction.get_merkle',
-                           [tx_hash, tx_height])
-                self.network.send([request], self.verify_merkle)
-                self.print_error('requested merkle', tx_hash)
+                requests.append(('blockchain.transaction.get_merkle',
+                                 [tx_hash, tx_height]))
                 self.merkle_roots[tx_hash] = None
+        if requests:
+            self.network.send(requests, self.verify_merkle)
+            self.print_error('requested %d merkle branches' % len(requests))
 
         if self.network.blockchain() != self.blockchain:
             self.blockchain = self.network.blockchain()
@@ -63,13 +69,16 @@ class SPV(ThreadJob):
         tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
         merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        header = self.network.blockchain().read_header(tx_height)
+        header = self.verified_headers.get(tx_height)
+        if not header or header.get('merkle_root') != merkle_root:
+            header = self.network.blockchain().read_header(tx_height)
         if not header or header.get('merkle_root') != merkle_root:
             # FIXME: we should make a fresh connection to a server to
             # recover from this, as this TX will now never verify
             self.print_error("merkle verification failed for", tx_hash)
             return
         # we passed all the tests
+        self.verified_headers[tx_height] = header
         self.merkle_roots[tx_hash] = merkle_root
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
@@ -83,6 +92,8 @@ class SPV(ThreadJob):
 
     def undo_verifications(self):
         height = self.blockchain.get_checkpoint()
+        for h in [h for h in self.verified_headers if h >= height]:
+            self.verified_headers.pop(h)
         tx_hashes = self.wallet.undo_verifications(self.blockchain, height)
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
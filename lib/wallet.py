@@ -28,6 +28,7 @@
 
 
 import os
+import sys
 import threading
 import random
 import time
@@ -35,14 +36,14 @@ import json
 import copy
 import errno
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from .i18n import _
 from .util import NotEnoughFunds, PrintError, UserCancelled, profiler, format_satoshis
 
 from .bitcoin import *
 from .version import *
-from .keystore import load_keystore, Hardware_KeyStore
+from .keystore import load_keystore, Hardware_KeyStore, Xpub
 from .storage import multisig_type
 
 from . import transaction
@@ -74,6 +75,10 @@ def relayfee(network):
     f = network.relay_fee if network and network.relay_fee else RELAY_FEE
     return min(f, MAX_RELAY_FEE)
 
+# bounds of the transactions made by make_batch_transactions
+MAX_BATCH_OUTPUTS = 500
+MAX_BATCH_TX_SIZE = 100000
+
 def dust_threshold(network):
     # Change <= dust threshold is added to the tx fee
     return 182 * 3 * relayfee(network) / 1000
@@ -147,6 +152,56 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100):
     return tx
 
 
+class ParsedTxCache(PrintError):
+    '''LRU of wallet transactions that are kept in parsed form.
+
+    Transactions keep their inputs and outputs once parsed. This cache
+    tracks which ones were used recently, and unloads the least recently
+    used ones (back to raw hex) when the total raw size of the parsed
+    transactions exceeds max_size bytes.
+    '''
+
+    def __init__(self, max_size=4*1024*1024):
+        self.max_size = max_size
+        self.size = 0
+        self.txs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def touch(self, tx_hash, tx):
+        if tx is None or tx.raw is None:
+            return
+        with self.lock:
+            if tx_hash in self.txs:
+                self.txs.move_to_end(tx_hash)
+                return
+            size = len(tx.raw) // 2
+            self.txs[tx_hash] = tx, size
+            self.size += size
+            while self.size > self.max_size and len(self.txs) > 1:
+                old_hash, (old_tx, old_size) = self.txs.popitem(last=False)
+                self.size -= old_size
+                old_tx.unload()
+
+    def pop(self, tx_hash):
+        with self.lock:
+            item = self.txs.pop(tx_hash, None)
+            if item is not None:
+                self.size -= item[1]
+
+    def clear(self):
+        with self.lock:
+            for tx, size in self.txs.values():
+                tx.unload()
+            self.txs.clear()
+            self.size = 0
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.txs
+
+    def __len__(self):
+        return len(self.txs)
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -170,7 +225,10 @@ class Abstract_Wallet(PrintError):
         self.multiple_change       = storage.get('multiple_change', False)
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.history               = storage.get('addr_history', {}, shared=True)        # address -> list(txid, height)
+
+        # wallet transactions that are kept parsed in memory
+        self.tx_cache = ParsedTxCache()
 
         self.load_keystore()
         self.load_addresses()
@@ -185,14 +243,26 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx = defaultdict(int)
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        self.verified_tx = storage.get('verified_tx3', {}, shared=True)
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
-        self.lock = threading.Lock()
-        self.transaction_lock = threading.Lock()
+        # set when tables are changed that are saved by autosave
+        self.state_changed = False
+        # reentrant, as storage writes take them again
+        self.lock = threading.RLock()
+        self.transaction_lock = threading.RLock()
+        self.storage.set_shared_locks([self.lock, self.transaction_lock])
+
+        self.compact_tables()
+        # hand the compacted tables to the storage, so that it drops the
+        # ones parsed from the wallet file; they are not changed by it
+        for key, value in [('addr_history', self.history), ('txi', self.txi), ('txo', self.txo),
+                           ('tx_fees', self.tx_fees), ('pruned_txo', self.pruned_txo),
+                           ('verified_tx3', self.verified_tx)]:
+            self.storage.replace(key, value)
 
         self.check_history()
 
@@ -216,11 +286,11 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
+        self.txi = self.storage.get('txi', {}, shared=True)
+        self.txo = self.storage.get('txo', {}, shared=True)
+        self.tx_fees = self.storage.get('tx_fees', {}, shared=True)
+        self.pruned_txo = self.storage.get('pruned_txo', {}, shared=True)
+        tx_list = self.storage.get('transactions', {}, shared=True)
         self.transactions = {}
         for tx_hash, raw in tx_list.items():
             tx = Transaction(raw)
@@ -231,30 +301,68 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def save_transactions(self, write=False):
-        with self.transaction_lock:
+        # self.history is changed under self.lock
+        with self.lock, self.transaction_lock:
             tx = {}
             for k,v in self.transactions.items():
                 tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            self.storage.put('addr_history', self.history)
+            self.storage.put('transactions', tx, shared=True)
+            self.storage.put('txi', self.txi, shared=True)
+            self.storage.put('txo', self.txo, shared=True)
+            self.storage.put('tx_fees', self.tx_fees, shared=True)
+            self.storage.put('pruned_txo', self.pruned_txo, shared=True)
+            self.storage.put('addr_history', self.history, shared=True)
             if write:
                 self.storage.write()
 
+    def get_transaction(self, tx_hash):
+        '''Return a wallet transaction, marking it as recently used
+        so that it stays parsed.'''
+        tx = self.transactions.get(tx_hash)
+        if tx is not None:
+            self.tx_cache.touch(tx_hash, tx)
+        return tx
+
     def clear_history(self):
         with self.transaction_lock:
             self.txi = {}
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
+            # no longer referenced, and dropped when the wallet is loaded
+            self.transactions = {}
+            self.tx_cache.clear()
         self.save_transactions()
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
 
+    @profiler
+    def compact_tables(self):
+        '''Keep the entries of the transaction tables as tuples, and share
+        the txid and address strings between tables.  Strings parsed from
+        the wallet file are all distinct objects, and lists are larger
+        than tuples.
+
+        Txids are kept as hex strings rather than bytes, and the tables
+        are not given a binary encoding: the rest of the wallet, the
+        network callbacks and the GUIs all look transactions up by their
+        hex txid.  This saves about 14% of the memory of the tables, see
+        scripts/bench_wallet_memory.'''
+        intern = sys.intern
+        def entries(l):
+            return [tuple(x) for x in l]
+        self.history = dict((intern(addr), hist if hist == ['*'] else [(intern(h), height) for h, height in hist])
+                            for addr, hist in self.history.items())
+        self.txi = dict((intern(tx_hash), dict((intern(addr), entries(l)) for addr, l in d.items()))
+                        for tx_hash, d in self.txi.items())
+        self.txo = dict((intern(tx_hash), dict((intern(addr), entries(l)) for addr, l in d.items()))
+                        for tx_hash, d in self.txo.items())
+        self.pruned_txo = dict((ser, intern(tx_hash)) for ser, tx_hash in self.pruned_txo.items())
+        self.tx_fees = dict((intern(tx_hash), fee) for tx_hash, fee in self.tx_fees.items())
+        self.transactions = dict((intern(tx_hash), tx) for tx_hash, tx in self.transactions.items())
+        self.verified_tx = dict((intern(tx_hash), tuple(info)) for tx_hash, info in self.verified_tx.items())
+
     @profiler
     def build_reverse_history(self):
         self.tx_addr_hist = {}
@@ -276,7 +384,7 @@ class Abstract_Wallet(PrintError):
             for tx_hash, tx_height in hist:
                 if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
-                tx = self.transactions.get(tx_hash)
+                tx = self.get_transaction(tx_hash)
                 if tx is not None:
                     self.add_transaction(tx_hash, tx)
                     save = True
@@ -373,6 +481,7 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+        self.schedule_autosave()
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -441,7 +550,7 @@ class Abstract_Wallet(PrintError):
             delta -= v
         # add the value of the coins received at address
         d = self.txo.get(tx_hash, {}).get(address, [])
-        for n, v, cb in d:
+        for n, v, cb, _type in d:
             delta += v
         return delta
 
@@ -459,7 +568,7 @@ class Abstract_Wallet(PrintError):
                 is_mine = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
-                for n, v, cb in d:
+                for n, v, cb, _type in d:
                     if n == item['prevout_n']:
                         value = v
                         break
@@ -550,7 +659,7 @@ class Abstract_Wallet(PrintError):
         sent = {}
         for tx_hash, height in h:
             l = self.txo.get(tx_hash, {}).get(address, [])
-            for n, v, is_cb in l:
+            for n, v, is_cb, _type in l:
                 received[tx_hash + ':%d'%n] = (height, v, is_cb)
         for tx_hash, height in h:
             l = self.txi.get(tx_hash, {}).get(address, [])
@@ -604,18 +713,13 @@ class Abstract_Wallet(PrintError):
         confirmed_only = config.get('confirmed_only', False)
         #return self.get_utxos(domain, exclude_frozen=True, mature=True, confirmed_only=confirmed_only)
         coins = self.get_utxos(domain, exclude_frozen=True, mature=True, confirmed_only=confirmed_only)
-        # filter p2pk utxo 
-        self.print_error("filter before coins : ", json.dumps(coins, indent=4))
-        for each in coins:
-            prevout_hash = each.get('prevout_hash')
-            prevout_n = each.get('prevout_n')
-            tx = self.transactions.get(prevout_hash)
-            tx.deserialize()
-            if(tx.outputs()[prevout_n][0] == TYPE_PUBKEY):
-                coins.remove(each)  
-            #self.print_error("after coins : ", json.dumps(tx.outputs(), indent=4))
-        self.print_error("after coins : ", json.dumps(coins, indent=4))
-        return coins
+        # filter p2pk utxo
+        return [x for x in coins if self.get_txo_type(x['address'], x['prevout_hash'], x['prevout_n']) != TYPE_PUBKEY]
+
+    def get_txo_type(self, address, prevout_hash, prevout_n):
+        for n, v, is_cb, _type in self.txo.get(prevout_hash, {}).get(address, []):
+            if n == prevout_n:
+                return _type
 
     def get_utxos(self, domain = None, exclude_frozen = False, mature = False, confirmed_only = False):
         coins = []
@@ -664,12 +768,13 @@ class Abstract_Wallet(PrintError):
     def find_pay_to_pubkey_address(self, prevout_hash, prevout_n):
         dd = self.txo.get(prevout_hash, {})
         for addr, l in dd.items():
-            for n, v, is_cb in l:
+            for n, v, is_cb, _type in l:
                 if n == prevout_n:
                     self.print_error("found pay-to-pubkey address:", addr)
                     return addr
 
     def add_transaction(self, tx_hash, tx):
+        tx_hash = sys.intern(tx_hash)
         is_coinbase = tx.inputs()[0]['type'] == 'coinbase'
         with self.transaction_lock:
             # add inputs
@@ -685,7 +790,7 @@ class Abstract_Wallet(PrintError):
                 # find value from prev output
                 if addr and self.is_mine(addr):
                     dd = self.txo.get(prevout_hash, {})
-                    for n, v, is_cb in dd.get(addr, []):
+                    for n, v, is_cb, _type in dd.get(addr, []):
                         if n == prevout_n:
                             if d.get(addr) is None:
                                 d[addr] = []
@@ -708,7 +813,7 @@ class Abstract_Wallet(PrintError):
                 if addr and self.is_mine(addr):
                     if d.get(addr) is None:
                         d[addr] = []
-                    d[addr].append((n, v, is_coinbase))
+                    d[addr].append((n, v, is_coinbase, _type))
                 # give v to txi that spends me
                 next_tx = self.pruned_txo.get(ser)
                 if next_tx is not None:
@@ -719,6 +824,7 @@ class Abstract_Wallet(PrintError):
                     dd[addr].append((ser, v))
             # save
             self.transactions[tx_hash] = tx
+            self.tx_cache.touch(tx_hash, tx)
 
     def remove_transaction(self, tx_hash):
         with self.transaction_lock:
@@ -750,8 +856,10 @@ class Abstract_Wallet(PrintError):
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_transaction(tx_hash, tx)
         self.add_unverified_tx(tx_hash, tx_height)
+        self.schedule_autosave()
 
     def receive_history_callback(self, addr, hist, tx_fees):
+        hist = [(sys.intern(tx_hash), height) for tx_hash, height in hist]
         with self.lock:
             old_hist = self.history.get(addr, [])
             for tx_hash, height in old_hist:
@@ -761,6 +869,7 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self.history[addr] = hist
+        self.schedule_autosave()
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -770,7 +879,7 @@ class Abstract_Wallet(PrintError):
             s.add(addr)
             self.tx_addr_hist[tx_hash] = s
             # if addr is new, we have to recompute txi and txo
-            tx = self.transactions.get(tx_hash)
+            tx = self.get_transaction(tx_hash)
             if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
                 self.add_transaction(tx_hash, tx)
 
@@ -840,7 +949,7 @@ class Abstract_Wallet(PrintError):
     def get_tx_status(self, tx_hash, height, conf, timestamp):
         from .util import format_time
         if conf == 0:
-            tx = self.transactions.get(tx_hash)
+            tx = self.get_transaction(tx_hash)
             if not tx:
                 return 3, 'unknown'
             is_final = tx and tx.is_final()
@@ -911,7 +1020,9 @@ class Abstract_Wallet(PrintError):
                 if not change_addrs:
                     change_addrs = [random.choice(addrs)]
             else:
-                change_addrs = [inputs[0]['address']]
+                # the coin chooser returns the change to the address
+                # of the largest input
+                change_addrs = []
 
         # Fee estimator
         if fixed_fee is None:
@@ -976,6 +1087,7 @@ class Abstract_Wallet(PrintError):
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
                 self.transactions.pop(tx_hash)
+                self.tx_cache.pop(tx_hash)
 
     def start_threads(self, network):
         self.network = network
@@ -984,11 +1096,33 @@ class Abstract_Wallet(PrintError):
             self.verifier = SPV(self.network, self)
             self.synchronizer = Synchronizer(self, network)
             network.add_jobs([self.verifier, self.synchronizer])
+            self.storage.set_autosave(network.config.get('autosave_delay', 30), self.save_changed_state)
+            for k in self.get_keystores():
+                k.sign_processes = network.config.get('sign_processes', 0)
         else:
             self.verifier = None
             self.synchronizer = None
 
+    def schedule_autosave(self):
+        '''Save the wallet state with the next autosave of the storage.'''
+        self.state_changed = True
+        self.storage.schedule_autosave()
+
+    def save_changed_state(self):
+        # autosave callback: the tables are only serialized again when
+        # the wallet changed them since the last autosave
+        if self.state_changed:
+            self.state_changed = False
+            self.save_state()
+
+    def save_state(self):
+        '''Put the wallet state kept outside of the storage.'''
+        self.save_transactions()
+        with self.lock:
+            self.storage.put('verified_tx3', self.verified_tx, shared=True)
+
     def stop_threads(self):
+        self.storage.set_autosave(0)
         if self.network:
             self.network.remove_jobs([self.synchronizer, self.verifier])
             self.synchronizer.release()
@@ -997,8 +1131,7 @@ class Abstract_Wallet(PrintError):
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
-        self.save_transactions()
-        self.storage.put('verified_tx3', self.verified_tx)
+        self.save_state()
         self.storage.write()
 
     def wait_until_synchronized(self, callback=None):
@@ -1129,7 +1262,7 @@ class Abstract_Wallet(PrintError):
         # First look up an input transaction in the wallet where it
         # will likely be.  If co-signing a transaction it may not have
         # all the input txs, in which case we ask the network.
-        tx = self.transactions.get(tx_hash)
+        tx = self.get_transaction(tx_hash)
         if not tx and self.network:
             request = ('blockchain.transaction.get', [tx_hash])
             tx = Transaction(self.network.synchronous_get(request))
@@ -1167,6 +1300,108 @@ class Abstract_Wallet(PrintError):
             except UserCancelled:
                 continue
 
+    def sign_transactions(self, txs, password):
+        '''Sign several transactions.  With software keystores they are
+        signed in threads, as libsecp256k1 releases the GIL.'''
+        threads = min(len(txs), os.cpu_count() or 1)
+        if threads < 2 or not bitcoin.coincurve or any(isinstance(k, Hardware_KeyStore) for k in self.get_keystores()):
+            for tx in txs:
+                self.sign_transaction(tx, password)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(lambda tx: self.sign_transaction(tx, password), txs))
+
+    def make_batch_transactions(self, coins, outputs, config, fixed_fee=None,
+                                change_addr=None, max_outputs=None, rbf=False, sign=None):
+        '''Split a payout to many outputs into transactions of at most
+        max_outputs (default MAX_BATCH_OUTPUTS) outputs and
+        MAX_BATCH_TX_SIZE vbytes.  They spend
+        coins from one snapshot without sharing any.  When the snapshot
+        runs out, the change of the transactions made so far is spent,
+        once they are signed with sign(txs) if their txid needs it.
+        Transactions not signed that way are passed to sign at the end.
+
+        With use_change, each transaction sends its change to an unused
+        change address of its own, so that the change does not link the
+        transactions of the batch.  Otherwise, as for single
+        transactions, the change goes back to the address of the
+        largest input, or to change_addr for all of them if it is
+        given.'''
+        if any(value == '!' for _type, data, value in outputs):
+            raise BaseException("Cannot spend max in a batch")
+        max_outputs = max_outputs or MAX_BATCH_OUTPUTS
+        pool = OrderedDict((coin['prevout_hash'] + ':%d' % coin['prevout_n'], coin) for coin in coins)
+        chain_change = not config.get('confirmed_only', False)
+        chunks = [outputs[i:i + max_outputs] for i in range(0, len(outputs), max_outputs)]
+        chunks.reverse()
+        txs = []
+        unsigned = []
+        # transactions whose change is not in the pool yet
+        locked = []
+        # change addresses given to the transactions so far
+        taken = set()
+        while chunks:
+            chunk = chunks.pop()
+            tx_change_addr = change_addr
+            if not change_addr and self.use_change:
+                tx_change_addr = self.get_fresh_change_address(taken)
+            try:
+                tx = self.make_unsigned_transaction(list(pool.values()), chunk, config, fixed_fee, tx_change_addr)
+            except NotEnoughFunds:
+                if not (chain_change and locked):
+                    raise
+                if sign and unsigned:
+                    sign(unsigned)
+                    unsigned = []
+                chained = [tx for tx in locked if tx.txid() is not None]
+                if not chained:
+                    raise
+                for tx in chained:
+                    self.add_change_coins(tx, pool)
+                locked = [tx for tx in locked if tx.txid() is None]
+                chunks.append(chunk)
+                continue
+            if len(chunk) > 1 and tx.estimated_size() > MAX_BATCH_TX_SIZE:
+                chunks.append(chunk[len(chunk)//2:])
+                chunks.append(chunk[:len(chunk)//2])
+                continue
+            if rbf:
+                tx.set_rbf(True)
+            for txin in tx.inputs():
+                pool.pop(txin['prevout_hash'] + ':%d' % txin['prevout_n'])
+            taken.add(tx_change_addr)
+            txs.append(tx)
+            unsigned.append(tx)
+            if chain_change and tx.txid() is not None:
+                self.add_change_coins(tx, pool)
+            else:
+                locked.append(tx)
+        if sign and unsigned:
+            sign(unsigned)
+        return txs
+
+    def add_change_coins(self, tx, coins):
+        '''Add the outputs of tx to the wallet to coins, as unconfirmed.'''
+        tx_hash = tx.txid()
+        for n, (_type, addr, value) in enumerate(tx.outputs()):
+            if _type == TYPE_ADDRESS and self.is_mine(addr):
+                coins[tx_hash + ':%d' % n] = {
+                    'address': addr,
+                    'value': value,
+                    'prevout_n': n,
+                    'prevout_hash': tx_hash,
+                    'height': 0,
+                    'coinbase': False,
+                }
+
+    def get_fresh_change_address(self, excluded):
+        '''Return a change address with no history that is not in
+        excluded, or None.'''
+        for addr in self.get_change_addresses()[-self.gap_limit_for_change:]:
+            if addr not in excluded and self.get_num_tx(addr) == 0:
+                return addr
+
     def get_unused_addresses(self):
         # fixme: use slots from expired requests
         domain = self.get_receiving_addresses()
@@ -1507,9 +1742,10 @@ class Imported_Wallet(Simple_Wallet):
                 self.verified_tx.pop(tx_hash, None)
                 self.unverified_tx.pop(tx_hash, None)
                 self.transactions.pop(tx_hash, None)
+                self.tx_cache.pop(tx_hash)
                 # FIXME: what about pruned_txo?
 
-        self.storage.put('verified_tx3', self.verified_tx)
+        self.storage.put('verified_tx3', self.verified_tx, shared=True)
         self.save_transactions()
 
         self.set_label(address, None)
@@ -1599,11 +1835,47 @@ class Imported_Wallet(Simple_Wallet):
 
 class Deterministic_Wallet(Abstract_Wallet):
 
+    # worker processes used to derive a batch of new addresses
+    derive_processes = 0
+    # save the pubkeys derived by the keystores in the wallet file
+    persist_pubkeys = False
+
     def __init__(self, storage):
         Abstract_Wallet.__init__(self, storage)
         self.gap_limit = storage.get('gap_limit', 20)
         #self.gap_limit = 600
 
+    def start_threads(self, network):
+        if network is not None:
+            self.derive_processes = network.config.get('derive_processes', 0)
+            self.persist_pubkeys = network.config.get('persist_pubkeys', False)
+        Abstract_Wallet.start_threads(self, network)
+
+    def get_xpub_keystores(self):
+        return [k for k in self.get_keystores() if isinstance(k, Xpub)]
+
+    def load_addresses(self):
+        Abstract_Wallet.load_addresses(self)
+        d = self.storage.get('pubkey_cache', {}, shared=True)
+        for k in self.get_xpub_keystores():
+            chains = d.get(k.xpub)
+            if not chains:
+                continue
+            k.load_pubkey_cache(chains)
+            # a stale cache is dropped if its first keys are wrong
+            c, cK = k.get_sequence_node(False)
+            if chains[0] and chains[0][0] != bh2u(bitcoin.CKD_pub(cK, c, 0)[0]):
+                self.print_error('discarding pubkey cache of', k.xpub)
+                k.pubkeys = {}
+
+    def save_addresses(self):
+        Abstract_Wallet.save_addresses(self)
+        if self.persist_pubkeys:
+            d = dict((k.xpub, k.get_pubkey_cache()) for k in self.get_xpub_keystores())
+            self.storage.put('pubkey_cache', d, shared=True)
+        else:
+            self.storage.put('pubkey_cache', None)
+
     def has_seed(self):
         return self.keystore.has_seed()
 
@@ -1662,27 +1934,41 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def get_fresh_change_address(self, excluded):
+        # past the gap limit, as the addresses before it will be used
+        # by the transactions they were given to
+        addr = Abstract_Wallet.get_fresh_change_address(self, excluded)
+        return addr or self.create_new_address(True)
+
+    def create_new_addresses(self, for_change, count):
         assert type(for_change) is bool
         addr_list = self.change_addresses if for_change else self.receiving_addresses
         n = len(addr_list)
-        x = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(x)
-        addr_list.append(address)
+        pubkeys = self.derive_pubkeys_range(for_change, n, count)
+        addresses = [self.pubkeys_to_address(x) for x in pubkeys]
+        addr_list.extend(addresses)
         self.save_addresses()
-        self.add_address(address)
-        return address
+        for address in addresses:
+            self.add_address(address)
+        return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if list(map(lambda a: self.address_is_old(a), addresses[-limit:] )) == limit*[False]:
+            # new addresses have no history, so the whole gap is known
+            # in advance: one past the last old address in the window
+            needed = max(0, limit - len(addresses))
+            window = addresses[-limit:]
+            for i in reversed(range(len(window))):
+                if self.address_is_old(window[i]):
+                    needed = i + 1 + limit - len(window)
+                    break
+            if needed == 0:
                 break
-            else:
-                self.create_new_address(for_change)
+            self.create_new_addresses(for_change, needed)
 
     def synchronize(self):
         with self.lock:
@@ -1750,6 +2036,7 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
         derivation = self.get_address_index(address)
         x_pubkey = self.keystore.get_xpubkey(*derivation)
         txin['x_pubkeys'] = [x_pubkey]
+        txin['pubkeys'] = [self.keystore.derive_pubkey(*derivation)]
         txin['signatures'] = [None]
         txin['num_sig'] = 1
 
@@ -1759,6 +2046,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_range(self, c, start, count):
+        return self.keystore.derive_pubkeys(c, start, count, self.derive_processes)
+
 
 
 
@@ -1793,6 +2083,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_range(self, c, start, count):
+        pubkeys = [k.derive_pubkeys(c, start, count, self.derive_processes) for k in self.get_keystores()]
+        return [list(x) for x in zip(*pubkeys)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -1841,12 +2135,15 @@ class Multisig_Wallet(Deterministic_Wallet):
         return ''.join(sorted(self.get_master_public_keys()))
 
     def add_input_sig_info(self, txin, address):
-        # x_pubkeys are not sorted here because it would be too slow
-        # they are sorted in transaction.get_sorted_pubkeys
-        # pubkeys is set to None to signal that x_pubkeys are unsorted
+        # x_pubkeys are sorted by pubkey, as in transaction.get_sorted_pubkeys;
+        # the keystores keep the pubkeys they derived
         derivation = self.get_address_index(address)
-        txin['x_pubkeys'] = [k.get_xpubkey(*derivation) for k in self.get_keystores()]
-        txin['pubkeys'] = None
+        keystores = self.get_keystores()
+        pubkeys = [k.derive_pubkey(*derivation) for k in keystores]
+        x_pubkeys = [k.get_xpubkey(*derivation) for k in keystores]
+        pubkeys, x_pubkeys = zip(*sorted(zip(pubkeys, x_pubkeys)))
+        txin['x_pubkeys'] = list(x_pubkeys)
+        txin['pubkeys'] = list(pubkeys)
         # we need n place holders
         txin['signatures'] = [None] * self.n
         txin['num_sig'] = self.m